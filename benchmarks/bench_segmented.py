@@ -0,0 +1,77 @@
+"""
+Compare downloading one large file over a single connection with the
+segmented download used for big files.
+
+A local server hands out a file with Range support and caps every
+connection at a fixed bandwidth, the way many file servers do, so the
+gain of several connections shows up without touching the real sites.
+
+Usage: python benchmarks/bench_segmented.py [--size-mb 32] [--segments 4] [--kbps 4096]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import http_client
+import file_download
+from mock_site import QuietHTTPServer, send_bytes
+
+
+def make_handler(payload, bytes_per_second):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            send_bytes(self, payload, bytes_per_second, etag='"bench"')
+
+    return Handler
+
+
+def run(url, folder, segments, size):
+    path = os.path.join(folder, f'file_{segments}.bin')
+    started = time.perf_counter()
+    ok = file_download.download_to_file(url, path, segment_threshold=1, segments=segments)
+    elapsed = time.perf_counter() - started
+    if not ok or os.path.getsize(path) != size:
+        raise SystemExit(f"Download with {segments} segment(s) failed")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=32, help='size of the test file')
+    parser.add_argument('--segments', type=int, default=4, help='connections used by the segmented download')
+    parser.add_argument('--kbps', type=int, default=4096, help='bandwidth cap per connection in KiB/s')
+    args = parser.parse_args()
+
+    payload = os.urandom(args.size_mb * 1024 * 1024)
+    server = QuietHTTPServer(('127.0.0.1', 0), make_handler(payload, args.kbps * 1024))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/file.bin'
+    http_client.configure(requests_per_second=1000)
+
+    folder = tempfile.mkdtemp(prefix='offlineparty-bench-')
+    try:
+        results = [(count, run(url, folder, count, len(payload))) for count in (1, args.segments)]
+    finally:
+        server.shutdown()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    print()
+    for count, elapsed in results:
+        print(f"{count} connection(s): {elapsed:6.2f}s  {args.size_mb / elapsed:7.2f} MB/s")
+    print(f"Speedup: {results[0][1] / results[1][1]:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
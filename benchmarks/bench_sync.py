@@ -0,0 +1,212 @@
+"""
+Measure the throughput of a sync against a local mock of Kemono/Coomer
+(see mock_site.py), without touching the real sites.
+
+Every scenario runs in its own process and folder, so it starts cold and
+its peak memory is its own:
+- artists: run_with_base_url over the favorited artists of Kemono
+- discord: scrape_discord_server over a server with several channels
+- favorites: fetch_favorite_artists, reading the favorites and creator
+  list and fetching the first page of every changed artist
+- user_search: user_search.main for a number of names, building the
+  creator index of both sites first
+
+Reported are pages/s (API pages of posts or messages), files/s, MB/s of
+file data, the peak RSS of the scenario's process and how many connections
+it opened for its requests (the rest reused a kept-alive one).
+
+Usage: python benchmarks/bench_sync.py [--scenario artists] [--artists 5] [--posts 100]
+       [--files-per-post 2] [--file-kb 64] [--latency-ms 20] [--kbps 0] [--error-rate 0] [--json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import mock_site
+
+SCENARIOS = ('artists', 'discord', 'favorites', 'user_search')
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes, or None where it can't be read."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def prepare(server_url, args):
+    """Point the script at the mock server and give it settings that never ask anything."""
+    import http_client
+    import get_favorites
+    from user_settings import load_settings, save_settings
+
+    get_favorites.create_config('Config')
+    settings = load_settings()
+    settings.update({
+        'stash_path': './',
+        'download_preference': 2,
+        'max_concurrent_downloads': args.downloads,
+        'max_downloads_per_host': args.downloads,
+        'scrape_comments': not args.no_comments,
+    })
+    save_settings(settings)
+    http_client.configure(pool_maxsize=max(http_client.DEFAULT_POOL_MAXSIZE, args.downloads),
+                          requests_per_second=args.requests_per_second)
+    mock_site.route_sites(server_url, pool_maxsize=max(http_client.DEFAULT_POOL_MAXSIZE, args.downloads))
+    # Stands in for the login cookie read from the browser
+    for site in mock_site.SITES:
+        get_favorites._session_cookies[site] = 'benchmark'
+
+
+def run_scenario(name, dataset):
+    """Run one scenario in this process and return extra numbers to report."""
+    import download
+    import get_favorites
+    import user_search
+    from dashboard import get_dashboard
+    from discord_download import scrape_discord_server
+
+    if name == 'artists':
+        favorites = dataset.favorites('kemono.su')
+        urls = [get_favorites.get_artist_url('kemono.su', artist['service'], artist['id']) for artist in favorites]
+        download.run_with_base_url(urls, download.create_artist_id_to_name_mapping(favorites), None)
+        return {'files_done': get_dashboard().summary()['downloaded']}
+    if name == 'discord':
+        scrape_discord_server(dataset.discord_server_id)
+        return {'files_done': get_dashboard().summary()['downloaded']}
+    if name == 'favorites':
+        artist_urls, _ = get_favorites.fetch_favorite_artists('kemono')
+        return {'artists_found': len(artist_urls)}
+    if name == 'user_search':
+        names = [creator['name'] for catalog in dataset.creators.values() for creator in catalog[::97]]
+        started = time.perf_counter()
+        found = sum(1 for name in names if user_search.main(name)[0])
+        return {'searches': len(names), 'found': found,
+                'searches_per_second': round(len(names) / (time.perf_counter() - started), 1)}
+    raise ValueError(f"Unknown scenario {name}")
+
+
+def child(args):
+    """Entry point of a scenario's process, prints its result as JSON on the last line."""
+    import http_client
+
+    dataset = make_dataset(args)
+    prepare(args.server, args)
+    started = time.perf_counter()
+    extra = run_scenario(args.child, dataset)
+    elapsed = time.perf_counter() - started
+    connections = http_client.connection_stats()['total']
+    sys.stdout = sys.__stdout__
+    print(json.dumps({'elapsed': elapsed, 'peak_rss': peak_rss(), 'connections': connections['connections'],
+                      'reused_connections': connections['reused'], **extra}))
+
+
+def make_dataset(args):
+    return mock_site.Dataset(artists=args.artists, posts_per_artist=args.posts, files_per_post=args.files_per_post,
+                             file_kb=args.file_kb, creators=args.creators, channels=args.channels,
+                             messages_per_channel=args.messages)
+
+
+def run(name, site, server_url, argv):
+    """Run scenario name in a fresh process and folder and return its results."""
+    folder = tempfile.mkdtemp(prefix=f'offlineparty-bench-{name}-')
+    site.reset_stats()
+    try:
+        result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', name, '--server', server_url,
+                                 *argv], cwd=folder, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    lines = result.stdout.strip().splitlines()
+    if result.returncode != 0 or not lines:
+        raise SystemExit(f"Scenario {name} failed:\n{result.stdout[-2000:]}\n{result.stderr[-2000:]}")
+    report = json.loads(lines[-1])
+    stats = site.stats()
+    elapsed = report['elapsed']
+    report.update({
+        'scenario': name,
+        'requests': stats['requests'],
+        'errors': stats['errors'],
+        'pages_per_second': round(stats['pages'] / elapsed, 2),
+        'files_per_second': round(stats['files'] / elapsed, 2),
+        'mb_per_second': round(stats['file_bytes'] / elapsed / (1024 * 1024), 2),
+    })
+    return report
+
+
+def print_table(reports):
+    print()
+    print(f"{'scenario':<12} {'time':>8} {'requests':>9} {'conns':>6} {'pages/s':>9} {'files/s':>9} {'MB/s':>8} "
+          f"{'peak RSS':>10}")
+    for report in reports:
+        rss = f"{report['peak_rss'] / (1024 * 1024):.0f} MB" if report['peak_rss'] else 'n/a'
+        print(f"{report['scenario']:<12} {report['elapsed']:7.2f}s {report['requests']:>9} {report['connections']:>6} "
+              f"{report['pages_per_second']:>9.1f} {report['files_per_second']:>9.1f} "
+              f"{report['mb_per_second']:>8.2f} {rss:>10}")
+        if 'searches_per_second' in report:
+            print(f"{'':<12} {report['searches']} searches, {report['searches_per_second']} searches/s")
+        if report['errors']:
+            print(f"{'':<12} {report['errors']} requests answered with an error")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append',
+                        help='scenario to run, can be repeated (all of them by default)')
+    parser.add_argument('--artists', type=int, default=5, help='favorited artists per site')
+    parser.add_argument('--posts', type=int, default=100, help='posts per artist')
+    parser.add_argument('--files-per-post', type=int, default=2, help='files per post or Discord message')
+    parser.add_argument('--file-kb', type=int, default=64, help='size of every file')
+    parser.add_argument('--creators', type=int, default=20000, help='creators in the creator list of each site')
+    parser.add_argument('--channels', type=int, default=4, help='channels of the Discord server')
+    parser.add_argument('--messages', type=int, default=300, help='messages per Discord channel')
+    parser.add_argument('--latency-ms', type=float, default=20, help='added to every answer of the mock server')
+    parser.add_argument('--kbps', type=int, default=0, help='bandwidth cap per connection in KiB/s, 0 is unlimited')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 500')
+    parser.add_argument('--downloads', type=int, default=8, help='max_concurrent_downloads of the script')
+    parser.add_argument('--requests-per-second', type=float, default=1000, help='rate limit of the script')
+    parser.add_argument('--no-comments', action='store_true', help='turn off scrape_comments')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--server', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    site = mock_site.MockSite(make_dataset(args), latency=args.latency_ms / 1000,
+                              bandwidth=args.kbps * 1024, error_rate=args.error_rate)
+    server_url = site.start()
+    # The scenario processes build the same dataset and settings
+    argv = [f'--{name.replace("_", "-")}={getattr(args, name)}'
+            for name in ('artists', 'posts', 'files_per_post', 'file_kb', 'creators', 'channels', 'messages',
+                         'downloads', 'requests_per_second')]
+    if args.no_comments:
+        argv.append('--no-comments')
+    try:
+        reports = [run(name, site, server_url, argv) for name in (args.scenario or SCENARIOS)]
+    finally:
+        site.stop()
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print_table(reports)
+
+
+if __name__ == '__main__':
+    main()
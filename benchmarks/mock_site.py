@@ -0,0 +1,323 @@
+"""
+Local stand-in for Kemono and Coomer, used by the benchmarks.
+
+It serves a generated dataset through the same endpoints the script uses:
+creators.txt, the favorites list, the post pages of an artist, Discord
+channels and their messages, post HTML pages (with comments) and the files
+themselves, with Range support. Latency, bandwidth per connection and a
+rate of failed answers can be set to get closer to the real sites.
+
+route_sites() sends every request for kemono.su and coomer.su made through
+http_client to the local server, so the script runs unchanged against it.
+"""
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+
+import http_client
+
+SITES = {
+    'kemono.su': 'patreon',
+    'coomer.su': 'onlyfans',
+}
+# Posts per page of /api/v1/{service}/user/{id}, like the real API
+PAGE_SIZE = 50
+# Messages per page of /api/v1/discord/channel/{id}
+DISCORD_PAGE_SIZE = 150
+# Pieces file bodies are sent in, the bandwidth cap sleeps between them
+SEND_PIECE = 64 * 1024
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def file_bytes(path, size):
+    """Content of a generated file, different for every path so deduplication doesn't kick in."""
+    seed = hashlib.sha256(path.encode('utf-8')).digest()
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def send_bytes(handler, payload, bytes_per_second=0, etag='"mock"', content_type='application/octet-stream'):
+    """
+    Answer handler's request with payload, honoring a Range header and
+    sending at most bytes_per_second (0 is unlimited) over the connection.
+    """
+    start, end = 0, len(payload) - 1
+    range_header = handler.headers.get('Range')
+    if range_header and range_header.startswith('bytes='):
+        first, _, last = range_header[len('bytes='):].partition('-')
+        start = int(first)
+        end = min(int(last), end) if last else end
+        handler.send_response(206)
+        handler.send_header('Content-Range', f'bytes {start}-{end}/{len(payload)}')
+    else:
+        handler.send_response(200)
+    handler.send_header('Content-Type', content_type)
+    handler.send_header('Content-Length', str(end - start + 1))
+    handler.send_header('Accept-Ranges', 'bytes')
+    handler.send_header('ETag', etag)
+    handler.end_headers()
+    if handler.command == 'HEAD':
+        return 0
+
+    position = start
+    try:
+        while position <= end:
+            data = payload[position:min(position + SEND_PIECE, end + 1)]
+            handler.wfile.write(data)
+            position += len(data)
+            if bytes_per_second:
+                time.sleep(len(data) / bytes_per_second)
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    return position - start
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    """Threading server that doesn't print a traceback when a client hangs up."""
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class Dataset:
+    """
+    Generated creators, posts and Discord messages. Everything is derived
+    from the numbers given, so two datasets with the same numbers are the
+    same and nothing has to be kept in memory per post or file.
+    """
+
+    def __init__(self, artists=5, posts_per_artist=100, files_per_post=2, file_kb=64, creators=20000,
+                 channels=4, messages_per_channel=300):
+        self.artists = artists
+        self.posts_per_artist = posts_per_artist
+        self.files_per_post = files_per_post
+        self.file_size = file_kb * 1024
+        self.channels = channels
+        self.messages_per_channel = messages_per_channel
+        self.discord_server_id = '900000000000000001'
+        self.creators = {}
+        for site, service in SITES.items():
+            name = site.split('.')[0]
+            catalog = [{'id': str(100000 + i), 'name': f'{name}-artist-{i}', 'service': service,
+                        'indexed': 1700000000, 'updated': 1700000000 + i, 'favorited': 1}
+                       for i in range(max(creators, artists))]
+            if site == 'kemono.su':
+                catalog.append({'id': self.discord_server_id, 'name': 'discord-server', 'service': 'discord',
+                                'indexed': 1700000000, 'updated': 1700000000, 'favorited': 1})
+            self.creators[site] = catalog
+        self._catalog_bodies = {site: json.dumps(catalog).encode('utf-8') for site, catalog in self.creators.items()}
+
+    def favorites(self, site):
+        """The favorited artists of site: the ones that have posts."""
+        return self.creators[site][:self.artists]
+
+    def catalog_body(self, site):
+        return self._catalog_bodies[site]
+
+    def _files(self, key, number, extension):
+        files = []
+        for index in range(self.files_per_post):
+            digest = _digest(f'{key}/{index}')
+            files.append({'name': f'{number}_{index}{extension}', 'path': f'/data/{digest[:2]}/{digest[2:4]}/{digest}{extension}'})
+        return files
+
+    def posts(self, site, service, artist_id, offset):
+        """A page of posts of an artist, newest first."""
+        creator_ids = {creator['id'] for creator in self.favorites(site)}
+        if artist_id not in creator_ids:
+            return []
+        posts = []
+        for number in range(self.posts_per_artist - offset, max(0, self.posts_per_artist - offset - PAGE_SIZE), -1):
+            files = self._files(f'{site}/{artist_id}/{number}', number, '.jpg')
+            posts.append({
+                # Post IDs are unique across artists, like on the real sites
+                'id': str(int(artist_id) * 1000000 + number),
+                'user': artist_id,
+                'service': service,
+                'title': f'Post {number}',
+                'content': f'<p>Text of post <b>{number}</b></p>',
+                'embed': {},
+                'published': f'2024-{number % 12 + 1:02d}-{number % 28 + 1:02d}T12:00:00',
+                'added': f'2024-{number % 12 + 1:02d}-{number % 28 + 1:02d}T12:30:00',
+                # Like on the real site the main file is also the first attachment
+                'file': files[0] if files else {},
+                'attachments': files,
+            })
+        return posts
+
+    def discord_channels(self, server_id):
+        if server_id != self.discord_server_id:
+            return []
+        return [{'id': str(800000000000000000 + index), 'name': f'channel-{index}'} for index in range(self.channels)]
+
+    def discord_messages(self, channel_id, skip):
+        """A page of messages of a channel, newest first."""
+        messages = []
+        for number in range(self.messages_per_channel - skip,
+                            max(0, self.messages_per_channel - skip - DISCORD_PAGE_SIZE), -1):
+            messages.append({
+                'id': str(int(channel_id) * 1000000 + number),
+                'channel': channel_id,
+                'content': f'Message {number}',
+                'embed': {},
+                'published': f'2024-01-01T{number // 3600 % 24:02d}:{number // 60 % 60:02d}:{number % 60:02d}',
+                'attachments': self._files(f'discord/{channel_id}/{number}', number, '.png'),
+            })
+        return messages
+
+    def post_html(self, post_id):
+        comments = ''.join(
+            f"<article class='comment'><a class='comment__name'>user{index}</a>"
+            f"<p class='comment__message'>Comment {index} on post {post_id}</p>"
+            f"<time class='timestamp'>2024-01-01</time></article>"
+            for index in range(3)
+        )
+        return f"<html><body>{'<div>page</div>' * 500}{comments}</body></html>".encode('utf-8')
+
+
+class MockSite:
+    """
+    The HTTP server of a Dataset. latency is added to every answer (in
+    seconds), bandwidth caps file transfers per connection (in bytes/s, 0 is
+    unlimited) and error_rate is the share of requests answered with a 500.
+    """
+
+    def __init__(self, dataset, latency=0.0, bandwidth=0, error_rate=0.0):
+        self.dataset = dataset
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'requests': 0, 'pages': 0, 'files': 0, 'file_bytes': 0, 'html_pages': 0, 'errors': 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, **amounts):
+        with self._lock:
+            for name, amount in amounts.items():
+                self._stats[name] += amount
+
+    def start(self, port=0):
+        """Start serving in the background and return the server's URL."""
+        self._server = QuietHTTPServer(('127.0.0.1', port), self._make_handler())
+        threading.Thread(target=self._server.serve_forever, name='mock-site', daemon=True).start()
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _make_handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                site._count(requests=1)
+                if site.latency:
+                    time.sleep(site.latency)
+                if site.error_rate and random.random() < site.error_rate:
+                    site._count(errors=1)
+                    return self.send_body(500, b'{"error": "mock failure"}')
+                try:
+                    site._answer(self)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def send_body(self, status, body, content_type='application/json', headers=None):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def send_json(self, data):
+                self.send_body(200, json.dumps(data).encode('utf-8'))
+
+        return Handler
+
+    def _answer(self, handler):
+        # Paths look like /kemono.su/api/v1/..., see route_sites
+        url = urlsplit(handler.path)
+        host, _, path = url.path.lstrip('/').partition('/')
+        path = '/' + path
+        query = parse_qs(url.query)
+        parts = path.strip('/').split('/')
+        dataset = self.dataset
+        if host not in SITES:
+            return handler.send_body(404, b'[]')
+
+        if path == '/api/v1/creators.txt':
+            if handler.headers.get('If-None-Match') == '"creators"':
+                return handler.send_body(304, b'')
+            return handler.send_body(200, dataset.catalog_body(host), headers={'ETag': '"creators"'})
+        if path == '/api/v1/account/favorites':
+            return handler.send_json(dataset.favorites(host))
+        if path.startswith('/api/v1/discord/channel/lookup/'):
+            return handler.send_json(dataset.discord_channels(parts[-1]))
+        if path.startswith('/api/v1/discord/channel/'):
+            self._count(pages=1)
+            return handler.send_json(dataset.discord_messages(parts[-1], int(query.get('skip', ['0'])[0])))
+        if len(parts) == 5 and parts[:2] == ['api', 'v1'] and parts[3] == 'user':
+            self._count(pages=1)
+            return handler.send_json(dataset.posts(host, parts[2], parts[4], int(query.get('o', ['0'])[0])))
+        if len(parts) == 5 and parts[1] == 'user' and parts[3] == 'post':
+            self._count(html_pages=1)
+            return handler.send_body(200, dataset.post_html(parts[4]), 'text/html')
+        if parts[0] == 'data':
+            sent = send_bytes(handler, file_bytes(path, dataset.file_size), self.bandwidth, etag=f'"{parts[-1]}"')
+            # Segmented downloads fetch a file in several ranges, only the first one counts as a file
+            first_range = handler.headers.get('Range', 'bytes=0-').startswith('bytes=0-')
+            self._count(files=1 if first_range and handler.command == 'GET' else 0, file_bytes=sent)
+            return
+        handler.send_body(404, b'[]')
+
+
+class _RedirectAdapter(HTTPAdapter):
+    """Sends requests for https://<site>/<path> to <server_url>/<site>/<path>."""
+
+    def __init__(self, server_url, **kwargs):
+        self.server_url = server_url
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = f"{self.server_url}/{url.netloc}{url.path}" + (f"?{url.query}" if url.query else '')
+        return super().send(request, **kwargs)
+
+
+def route_sites(server_url, pool_maxsize=32):
+    """Send every request http_client makes to Kemono or Coomer to the mock server at server_url."""
+    adapter = _RedirectAdapter(server_url, pool_maxsize=pool_maxsize)
+    session = http_client.get_session()
+    for host in SITES:
+        session.mount(f'https://{host}/', adapter)
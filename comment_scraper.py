@@ -0,0 +1,89 @@
+import os
+import threading
+import http_client
+from metrics import get_metrics
+from bs4 import BeautifulSoup, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
+
+# Post pages fetched at once; the per-site rate limit in http_client still applies
+DEFAULT_WORKERS = 4
+COMMENTS_HEADER = "[COMMENTS]\n"
+
+try:
+    import lxml  # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+# Only the comment articles are turned into a tree, the rest of the page is skipped
+COMMENT_STRAINER = SoupStrainer('article', class_='comment')
+
+
+def parse_comments(html):
+    """Return the comments of a post page as 'user - message - timestamp' lines."""
+    soup = BeautifulSoup(html, PARSER, parse_only=COMMENT_STRAINER)
+    comment_list = []
+    for comment in soup.find_all('article', class_='comment'):
+        user = comment.find('a', class_='comment__name')
+        message = comment.find('p', class_='comment__message')
+        timestamp = comment.find('time', class_='timestamp')
+        if user and message and timestamp:
+            comment_list.append(f"{user.text} - {message.text} - {timestamp.text}")
+    return comment_list
+
+
+def write_comments(content_path, comments):
+    """Add or replace the [COMMENTS] section at the end of a content.txt file."""
+    with open(content_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    position = text.find(COMMENTS_HEADER)
+    if position != -1 and (position == 0 or text[position - 1] == '\n'):
+        text = text[:position]
+    if comments:
+        text += COMMENTS_HEADER + '\n'.join(comments) + "\n"
+    with open(content_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+class CommentScraper:
+    """
+    Background stage that fetches the comments of posts and adds them to
+    their content.txt, so neither the post texts nor the file downloads
+    wait on the post pages. When each post's comments were fetched is kept
+    in the stash ledger, so they're only fetched again on the schedule.
+    """
+
+    def __init__(self, ledger, max_workers=DEFAULT_WORKERS):
+        self.ledger = ledger
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='comments')
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def submit(self, post_url, content_path, domain, service, artist_id, post_id):
+        future = self._executor.submit(self._scrape, post_url, content_path, domain, service, artist_id, post_id)
+        with self._lock:
+            self._futures = [f for f in self._futures if not f.done()]
+            self._futures.append(future)
+        return future
+
+    def _scrape(self, post_url, content_path, domain, service, artist_id, post_id):
+        try:
+            with get_metrics().stage('comments'):
+                response = http_client.get(post_url)
+                response.raise_for_status()
+                comments = parse_comments(response.text)
+                if os.path.exists(content_path):
+                    write_comments(content_path, comments)
+                self.ledger.record_comment_scan(domain, service, artist_id, post_id)
+        except Exception as e:
+            print(f"Error fetching comments from {post_url}: {e}")
+
+    def wait(self):
+        """Block until every queued post has been handled."""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import threading
+import http_client
+from file_lock import locked
+
+CATALOG_DIR = 'Config'
+SITE_URLS = {
+    'kemono': 'https://kemono.su',
+    'coomer': 'https://coomer.su',
+}
+# How long a downloaded catalog is used before asking the server if it changed
+DEFAULT_TTL_HOURS = 1
+
+_ttl_hours = DEFAULT_TTL_HOURS
+_catalogs = {}  # site -> (creators, loaded_at)
+_locks = {site: threading.Lock() for site in SITE_URLS}
+
+
+def configure(ttl_hours=None):
+    global _ttl_hours
+    if ttl_hours is not None:
+        _ttl_hours = ttl_hours
+
+
+def _paths(site):
+    return (os.path.join(CATALOG_DIR, f"creators_{site}.json"),
+            os.path.join(CATALOG_DIR, f"creators_{site}.meta.json"))
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(meta_path, meta):
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+
+def _load_from_disk(catalog_path):
+    try:
+        with open(catalog_path, 'rb') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _refresh(site, cached=None):
+    """
+    Return the catalog of site, using the copy in Config/ while it's younger
+    than the TTL and revalidating it with ETag/If-Modified-Since otherwise.
+    cached is the (creators, loaded_at) already in memory, returned as is
+    while it's still current so the indexes built from it stay valid.
+    """
+    catalog_path, meta_path = _paths(site)
+    meta = _read_meta(meta_path)
+    creators = None
+    if meta:
+        if cached and cached[1] >= meta.get('fetched_at', 0):
+            creators = cached[0]
+        else:
+            # Not loaded yet, or another process saved a newer copy
+            creators = _load_from_disk(catalog_path)
+
+    if creators is not None and time.time() - meta.get('fetched_at', 0) < _ttl_hours * 3600:
+        return creators
+
+    headers = {}
+    if creators is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = http_client.get(f"{SITE_URLS[site]}/api/v1/creators.txt", headers=headers)
+        if response.status_code == 304 and creators is not None:
+            meta['fetched_at'] = time.time()
+            _write_meta(meta_path, meta)
+            return creators
+
+        response.raise_for_status()
+        body = response.content
+        creators = json.loads(body)
+    except Exception as e:
+        if creators is not None:
+            print(f"Could not refresh the {site} creator list, using the saved copy: {e}")
+            return creators
+        raise
+
+    os.makedirs(CATALOG_DIR, exist_ok=True)
+    temp_path = f"{catalog_path}.{os.getpid()}.temp"
+    with open(temp_path, 'wb') as f:
+        f.write(body)
+    os.replace(temp_path, catalog_path)
+    _write_meta(meta_path, {
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'fetched_at': time.time(),
+    })
+    return creators
+
+
+def get_creators(site):
+    """
+    Return the list of every creator on site ("kemono" or "coomer").
+
+    The list is kept in memory for the rest of the process, so every caller
+    shares one copy instead of downloading the multi-MB creators.txt again.
+    """
+    with _locks[site]:
+        cached = _catalogs.get(site)
+        if cached and time.time() - cached[1] < _ttl_hours * 3600:
+            return cached[0]
+
+        # Other processes (see --shard) wait for the one refreshing the list and then reuse its copy
+        with locked(_paths(site)[0]):
+            creators = _refresh(site, cached)
+        _catalogs[site] = (creators, time.time())
+        return creators
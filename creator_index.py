@@ -0,0 +1,103 @@
+import difflib
+import threading
+from array import array
+from collections import Counter
+import creator_catalog
+
+
+def normalize_name(name):
+    """Lowercase a creator name and collapse its whitespace for comparisons."""
+    return ' '.join(str(name or '').lower().split())
+
+
+def _trigrams(name):
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CreatorIndex:
+    """
+    Lookup tables built once from a creators.txt catalog, so finding a
+    creator by ID or name doesn't scan the whole list every time.
+    """
+
+    def __init__(self, creators):
+        self.by_id = {}  # id -> records, the same ID can exist on several services
+        self.by_service_id = {}  # (service, id) -> record
+        self.by_name = {}  # normalized name -> records
+        for creator in creators:
+            creator_id = str(creator.get('id', ''))
+            service = str(creator.get('service', '')).lower()
+            self.by_id.setdefault(creator_id, []).append(creator)
+            self.by_service_id[(service, creator_id)] = creator
+            self.by_name.setdefault(normalize_name(creator.get('name')), []).append(creator)
+
+        self._names = sorted(self.by_name)
+        self._trigram_index = None
+        self._trigram_lock = threading.Lock()
+
+    def get(self, creator_id, service=None):
+        """Return the creator with creator_id (on service, if given) or None."""
+        creator_id = str(creator_id)
+        if service:
+            return self.by_service_id.get((service.lower(), creator_id))
+        matches = self.by_id.get(creator_id)
+        return matches[0] if matches else None
+
+    def find_by_name(self, name):
+        """Return every creator whose name matches exactly, ignoring case."""
+        return list(self.by_name.get(normalize_name(name), []))
+
+    def _get_trigram_index(self):
+        # Only built the first time a fuzzy search is needed
+        with self._trigram_lock:
+            if self._trigram_index is None:
+                index = {}
+                for position, name in enumerate(self._names):
+                    for gram in _trigrams(name):
+                        positions = index.get(gram)
+                        if positions is None:
+                            positions = index[gram] = array('I')
+                        positions.append(position)
+                self._trigram_index = index
+            return self._trigram_index
+
+    def suggest(self, name, limit=5, cutoff=0.7):
+        """
+        Return up to limit creator names that look like name, for when a
+        search had no exact match (typos, missing characters...).
+        """
+        name = normalize_name(name)
+        if not name:
+            return []
+
+        index = self._get_trigram_index()
+        shared = Counter()
+        for gram in _trigrams(name):
+            shared.update(index.get(gram, ()))
+
+        candidates = [self._names[position] for position, _ in shared.most_common(200)]
+        return difflib.get_close_matches(name, candidates, n=limit, cutoff=cutoff)
+
+
+_indexes = {}  # site -> (catalog the index was built from, index)
+_indexes_lock = threading.Lock()
+
+
+def get_creator_index(site=None):
+    """
+    Return the index of site ("kemono" or "coomer"), or of both sites when
+    site is None. It is rebuilt only when the shared catalog changes.
+    """
+    sites = [site] if site else list(creator_catalog.SITE_URLS)
+    catalogs = [creator_catalog.get_creators(name) for name in sites]
+
+    with _indexes_lock:
+        cached = _indexes.get(site)
+        if cached and len(cached[0]) == len(catalogs) and all(a is b for a, b in zip(cached[0], catalogs)):
+            return cached[1]
+
+        creators = catalogs[0] if len(catalogs) == 1 else [creator for catalog in catalogs for creator in catalog]
+        index = CreatorIndex(creators)
+        _indexes[site] = (catalogs, index)
+        return index
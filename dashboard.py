@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+from collections import deque
+from datetime import datetime
+from download_pool import pool_stats
+from metrics import get_metrics
+
+# Seconds between redraws of the dashboard
+REFRESH_INTERVAL = 0.5
+# Seconds between status lines when the output isn't a terminal or in quiet mode
+STATUS_INTERVAL = 60
+# Speeds are averaged over this many seconds
+RATE_WINDOW = 10
+MAX_TRANSFERS_SHOWN = 8
+
+COUNT_KINDS = ('downloaded', 'reused', 'skipped', 'failed', 'posts', 'known_posts')
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+    return f"{size:.2f} TB"
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s" if hours else f"{minutes}m {seconds:02d}s"
+
+
+class Transfer:
+    """Progress of one file download, shown on the dashboard while it runs."""
+
+    def __init__(self, dashboard, name, total):
+        self._dashboard = dashboard
+        self.name = name
+        self.total = total
+        self.done = 0
+
+    def update(self, size):
+        """size more bytes were downloaded."""
+        self.done += size
+        self._dashboard._add_bytes(size)
+
+    def set_progress(self, done):
+        """Set how much of the file is on disk, e.g. when resuming, without counting it as downloaded."""
+        self.done = done
+
+    def close(self):
+        self._dashboard._end_transfer(self)
+
+
+class _Output:
+    """Stands in for sys.stdout while the dashboard is shown, so prints scroll above it."""
+
+    def __init__(self, dashboard, stream):
+        self._dashboard = dashboard
+        self._stream = stream
+
+    def write(self, text):
+        return self._dashboard._write(text)
+
+    def flush(self):
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class Dashboard:
+    """
+    Live overview of a download run: the current artist, how many files were
+    downloaded/reused/skipped/failed, bytes/s and files/s, the download queue
+    and the running transfers.
+
+    On a terminal it's redrawn in place a few times per second below the
+    normal output, without clearing the screen. When the output is piped
+    a status line is printed every minute instead, and in quiet mode the
+    normal output is dropped and only JSON status lines are printed.
+    """
+
+    def __init__(self):
+        self.quiet = False
+        self._lock = threading.RLock()
+        self._users = 0
+        self._mode = None
+        self._stream = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._reset()
+
+    def _reset(self):
+        self._counts = dict.fromkeys(COUNT_KINDS, 0)
+        self._artist_counts = dict.fromkeys(COUNT_KINDS, 0)
+        self._bytes = 0
+        self._transfers = []
+        self._artist = None
+        self._channel = None
+        self._position = None
+        self._total = None
+        self._started_at = time.monotonic()
+        self._samples = deque([(self._started_at, 0, 0)])
+        self._drawn_lines = 0
+        self._line_start = True
+
+    def configure(self, quiet=None):
+        if quiet is not None:
+            self.quiet = quiet
+
+    # Updates from the download code
+
+    def set_artist(self, name, channel=None, position=None, total=None):
+        """Show name (and channel) as the artist being downloaded, position out of total artists."""
+        with self._lock:
+            if name != self._artist:
+                self._artist_counts = dict.fromkeys(COUNT_KINDS, 0)
+            self._artist = name
+            self._channel = channel
+            if position is not None:
+                self._position = position
+            if total is not None:
+                self._total = total
+
+    def count(self, kind, amount=1, reason=None):
+        """
+        Count a finished file ('downloaded', 'reused', 'skipped', 'failed') or
+        post ('posts', 'known_posts'). reason says why a file was skipped.
+        The counts also go to the metrics (see metrics.py).
+        """
+        with self._lock:
+            self._counts[kind] += amount
+            self._artist_counts[kind] += amount
+        if kind in ('posts', 'known_posts'):
+            get_metrics().count('posts_total', amount, result='new' if kind == 'posts' else 'known')
+        elif reason:
+            get_metrics().count('files_total', amount, outcome=kind, reason=reason)
+        else:
+            get_metrics().count('files_total', amount, outcome=kind)
+
+    def transfer(self, name, total):
+        transfer = Transfer(self, name, total)
+        with self._lock:
+            self._transfers.append(transfer)
+        return transfer
+
+    def _add_bytes(self, size):
+        with self._lock:
+            self._bytes += size
+        get_metrics().count('downloaded_bytes_total', size)
+
+    def _end_transfer(self, transfer):
+        with self._lock:
+            if transfer in self._transfers:
+                self._transfers.remove(transfer)
+
+    # Starting and stopping
+
+    def start(self):
+        """Show the dashboard until the matching stop(). Calls can be nested."""
+        with self._lock:
+            self._users += 1
+            if self._users > 1:
+                return
+            self._reset()
+            self._stream = sys.stdout
+            if self.quiet:
+                self._mode = 'quiet'
+            elif self._stream.isatty():
+                self._mode = 'live'
+                if os.name == 'nt':
+                    os.system('')  # Turns on ANSI escape codes in the Windows console
+            else:
+                self._mode = 'plain'
+            if self._mode != 'plain':
+                sys.stdout = _Output(self, self._stream)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='dashboard', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            self._users = 0
+            thread = self._thread
+        self._stop.set()
+        if thread:
+            thread.join()
+        with self._lock:
+            self._erase()
+            if self._mode == 'quiet':
+                self._write_json('summary')
+            else:
+                self._stream.write(self._summary_line() + "\n")
+            self._stream.flush()
+            if self._mode != 'plain':
+                sys.stdout = self._stream
+            self._thread = None
+            self._mode = None
+
+    def _loop(self):
+        interval = REFRESH_INTERVAL if self._mode == 'live' else STATUS_INTERVAL
+        while not self._stop.wait(interval):
+            with self._lock:
+                if self._mode == 'live':
+                    self._draw()
+                elif self._mode == 'quiet':
+                    self._write_json('status')
+                else:
+                    self._stream.write(self._status_line() + "\n")
+                    self._stream.flush()
+
+    # Output
+
+    def _write(self, text):
+        with self._lock:
+            if self._mode == 'quiet':
+                return len(text)
+            if text:
+                self._erase()
+                self._stream.write(text)
+                self._line_start = text.endswith('\n')
+            return len(text)
+
+    def _erase(self):
+        if self._drawn_lines:
+            # Back to the first line of the dashboard and clear everything below it
+            self._stream.write(f"\033[{self._drawn_lines}F\033[J")
+            self._drawn_lines = 0
+
+    def _draw(self):
+        if not self._line_start:
+            return  # Don't split a line that is still being printed
+        width = max(20, shutil.get_terminal_size().columns - 1)
+        lines = [line[:width] for line in self._render()]
+        self._erase()
+        self._stream.write("\n".join(lines) + "\n")
+        self._stream.flush()
+        self._drawn_lines = len(lines)
+
+    def _rates(self):
+        """Return (bytes/s, files/s) over the last RATE_WINDOW seconds."""
+        now = time.monotonic()
+        files = self._counts['downloaded'] + self._counts['reused']
+        self._samples.append((now, self._bytes, files))
+        while len(self._samples) > 2 and now - self._samples[0][0] > RATE_WINDOW:
+            self._samples.popleft()
+        first = self._samples[0]
+        elapsed = now - first[0]
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return (self._bytes - first[1]) / elapsed, (files - first[2]) / elapsed
+
+    def _render(self):
+        bytes_per_second, files_per_second = self._rates()
+        queue = pool_stats()
+        counts = self._counts
+        separator = '=' * 60
+
+        artist = self._artist or "-"
+        if self._channel:
+            artist += f" in channel: {self._channel}"
+        if self._position and self._total:
+            artist = f"[{self._position}/{self._total}] {artist}"
+
+        lines = [
+            separator,
+            f"Downloading posts from: {artist}",
+            f"  This artist: {self._artist_counts['posts']} new posts, {self._artist_counts['known_posts']} already "
+            f"downloaded, {self._artist_counts['downloaded'] + self._artist_counts['reused']} files",
+            f"Files: {counts['downloaded']} downloaded, {counts['reused']} reused, {counts['skipped']} skipped, "
+            f"{counts['failed']} failed | {files_per_second:.1f} files/s",
+            f"Data: {format_size(self._bytes)} at {format_size(bytes_per_second)}/s | "
+            f"Queue: {queue['waiting']} waiting, {len(self._transfers)} transferring",
+        ]
+        for transfer in self._transfers[:MAX_TRANSFERS_SHOWN]:
+            if transfer.total:
+                progress = f"{transfer.done * 100 // transfer.total:3d}% {format_size(transfer.done)} / {format_size(transfer.total)}"
+            else:
+                progress = format_size(transfer.done)
+            lines.append(f"  {progress:>28}  {transfer.name}")
+        if len(self._transfers) > MAX_TRANSFERS_SHOWN:
+            lines.append(f"  ... and {len(self._transfers) - MAX_TRANSFERS_SHOWN} more")
+        lines.append(separator)
+        return lines
+
+    def _status_line(self):
+        bytes_per_second, files_per_second = self._rates()
+        counts = self._counts
+        return (f"[{datetime.now():%H:%M:%S}] {self._artist or '-'}: {counts['downloaded']} downloaded, "
+                f"{counts['reused']} reused, {counts['skipped']} skipped, {counts['failed']} failed, "
+                f"{format_size(self._bytes)} at {format_size(bytes_per_second)}/s, {files_per_second:.1f} files/s")
+
+    def _summary_line(self):
+        counts = self._counts
+        return (f"Downloaded {counts['downloaded']} files ({format_size(self._bytes)}), reused {counts['reused']}, "
+                f"skipped {counts['skipped']}, failed {counts['failed']} "
+                f"in {format_duration(time.monotonic() - self._started_at)}")
+
+    def summary(self):
+        """Counters of the current run as a dict."""
+        with self._lock:
+            bytes_per_second, files_per_second = self._rates()
+            return {
+                **self._counts,
+                'bytes': self._bytes,
+                'bytes_per_second': round(bytes_per_second, 1),
+                'files_per_second': round(files_per_second, 2),
+                'elapsed_seconds': round(time.monotonic() - self._started_at, 1),
+                'artist': self._artist,
+                'queued': pool_stats()['waiting'],
+                'transferring': len(self._transfers),
+            }
+
+    def _write_json(self, event):
+        record = {'time': datetime.now().isoformat(timespec='seconds'), 'event': event, **self.summary()}
+        self._stream.write(json.dumps(record) + "\n")
+        self._stream.flush()
+
+
+_dashboard = Dashboard()
+
+
+def get_dashboard():
+    return _dashboard
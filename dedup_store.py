@@ -0,0 +1,183 @@
+import os
+import re
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from stash_ledger import get_stash_ledger
+
+# Kemono/Coomer store every file under the SHA-256 of its content,
+# e.g. /data/ab/cd/abcd...ef.jpg
+HASH_PATTERN = re.compile(r'/([0-9a-fA-F]{64})(?:\.[^/]*)?$')
+# ioctl that makes a copy-on-write clone of a file (Btrfs, XFS, ...)
+FICLONE = 0x40049409
+# Bytes read at a time when hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_hash(url):
+    """Return the content hash in the path of a Kemono/Coomer file URL, or None."""
+    match = HASH_PATTERN.search(urlsplit(url).path)
+    return match.group(1).lower() if match else None
+
+
+def file_hash_of(path):
+    """Return the SHA-256 of the file at path, as the lowercase hex used in file URLs."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reflink(source, destination):
+    import fcntl
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def materialize(source, destination):
+    """
+    Make destination a copy of source without downloading it again: a hard
+    link if possible, a copy-on-write clone if the file system supports it
+    and a plain copy otherwise. Returns the method that was used.
+    """
+    try:
+        os.link(source, destination)
+        return 'hardlink'
+    except OSError:
+        pass
+
+    temp_path = destination + '.dedup'
+    try:
+        try:
+            _reflink(source, temp_path)
+            method = 'reflink'
+        except (OSError, ImportError):
+            shutil.copyfile(source, temp_path)
+            method = 'copy'
+        os.replace(temp_path, destination)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return method
+
+
+class DedupStore:
+    """
+    Index of every downloaded file by its content hash, kept in the stash
+    ledger. A file that is attached to several posts, is both the main file
+    and an attachment, or is mirrored between Kemono and Discord is only
+    downloaded once; every other copy is made from the one on disk.
+    """
+
+    def __init__(self, stash_path):
+        self.root = os.path.abspath(stash_path)
+        self.ledger = get_stash_ledger(stash_path)
+        self.files_reused = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._hash_locks = {}  # hash -> [lock, users]
+
+    @contextmanager
+    def claim(self, url):
+        """
+        Hold this around reuse() and the download of url, so two downloads
+        of the same content running at once don't both hit the network.
+        """
+        file_hash = content_hash(url)
+        if not file_hash:
+            yield
+            return
+        with self._lock:
+            entry = self._hash_locks.setdefault(file_hash, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._hash_locks[file_hash]
+
+    def reuse(self, url, destination, disk_ledger=None):
+        """
+        Create destination from a stored file with the same content hash as
+        url. Returns False if there is none and the file has to be downloaded.
+        """
+        file_hash = content_hash(url)
+        if not file_hash:
+            return False
+        entry = self.ledger.find_file(file_hash)
+        if entry is None:
+            return False
+
+        source = os.path.join(self.root, entry[0])
+        try:
+            if os.path.getsize(source) != entry[1]:
+                raise FileNotFoundError(source)
+        except OSError:
+            # The stored copy was deleted or changed since, download it again
+            self.ledger.forget_file(file_hash)
+            return False
+
+        try:
+            method = materialize(source, destination)
+        except OSError as e:
+            print(f"Could not reuse {source}, downloading it again: {e}")
+            return False
+
+        # Every link counts towards the stash size, just like when it's recounted from disk
+        if disk_ledger:
+            disk_ledger.add(entry[1])
+        with self._lock:
+            self.files_reused += 1
+            self.bytes_saved += entry[1]
+        print(f"Reused {os.path.basename(destination)} from {entry[0]} ({method})")
+        return True
+
+    def remember(self, url, path, verify=False):
+        """
+        Add a file that is on disk to the index, if its URL has a content hash.
+        With verify, the file wasn't downloaded from url by this process (it
+        was found on disk under the same name), so it's only added if its
+        content really has that hash; otherwise reuse() could copy the wrong
+        file into other posts.
+        """
+        file_hash = content_hash(url)
+        if not file_hash or not os.path.exists(path):
+            return
+        if verify:
+            if self.ledger.find_file(file_hash) is not None:
+                return  # Already indexed, no need to read the file
+            try:
+                if file_hash_of(path) != file_hash:
+                    return
+            except OSError:
+                return
+        self.ledger.record_file(file_hash, os.path.relpath(os.path.abspath(path), self.root),
+                                os.path.getsize(path))
+
+    def report(self):
+        """Print how much downloading was saved so far, and reset the counters."""
+        with self._lock:
+            files, saved = self.files_reused, self.bytes_saved
+            self.files_reused = self.bytes_saved = 0
+        if files:
+            print(f"Reused {files} file(s) already in your stash instead of downloading "
+                  f"{saved / (1024 * 1024):.2f} MB again")
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_dedup_store(stash_path):
+    """Return the dedup store of the stash at stash_path."""
+    root = os.path.abspath(stash_path)
+    with _stores_lock:
+        if root not in _stores:
+            _stores[root] = DedupStore(stash_path)
+        return _stores[root]
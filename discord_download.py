@@ -1,59 +1,40 @@
 import os
-import yaml
 import requests
-from tqdm import tqdm
+import http_client
+import file_download
+import download_plan
+from collections import deque
+from itertools import takewhile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from creator_index import get_creator_index
 from pathvalidate import sanitize_filename
+from dedup_store import get_dedup_store
+from download_pool import get_download_pool, wait_for_jobs
+from stash_ledger import get_stash_ledger
+from post_text import PostTextWriter
 from json_handling import save_to_kemono_favorites
+from user_settings import load_settings, save_settings, get_settings
+from dashboard import get_dashboard
+from metrics import get_metrics, save_metrics
 
-CONFIG_PATH = "Config"
-SETTINGS_FILE = os.path.join(CONFIG_PATH, "user_settings.yaml")
 BASE_URL = "https://kemono.su"  # Updated base URL
+# Pages of a channel fetched ahead of their downloads
+DISCORD_PAGES_AHEAD = 2
 
-def read_stash_path_from_yaml():
-    """Read stash_path from the YAML settings file."""
-    if os.path.exists(SETTINGS_FILE):
-        with open(SETTINGS_FILE, 'r') as f:
-            settings = yaml.safe_load(f)
-            return settings.get('stash_path', '')
-    return ''
-
-
-def clear_console(artist_name_or_id, channel_name=None):
-    """Clear the console and display the header."""
-    os.system('cls' if os.name == 'nt' else 'clear')
-    print(f"{'='*80}")
-    if channel_name:
-        print(f"Downloading posts from: {artist_name_or_id} in channel: {channel_name}")
-    else:
-        print(f"Downloading posts from: {artist_name_or_id}")
-    print(f"{'='*80}\n")
-
-
-
-def fetch_creator_data():
-    # Fetching creator data from kemono using the API endpoint
-    return requests.get("https://kemono.su/api/v1/creators.txt").json()
 
-
-def get_artist_name_from_id(artist_id, combined_data):
+def get_artist_name_from_id(artist_id, creators):
     """
-    Given an artist ID and a combined list of creators, return the artist's name.
+    Given an artist ID and the index of Kemono creators, return the artist's name.
     """
-    for creator in combined_data:
-        if creator['id'] == artist_id:
-            return creator['name']
-    return None
+    creator = creators.get(artist_id, 'discord') or creators.get(artist_id)
+    return creator['name'] if creator else None
 
 
 def get_or_set_download_preference():
     """Get the user's download preference or prompt them to set it."""
-    settings = {}
-    if os.path.exists(SETTINGS_FILE):
-        with open(SETTINGS_FILE, 'r') as f:
-            settings = yaml.safe_load(f)
-            preference = settings.get('download_preference', 0)
-            if preference != 0:
-                return str(preference)
+    preference = get_settings()['download_preference']
+    if preference != 0:
+        return str(preference)
 
     # Prompt the user for their preference
     choice = ''
@@ -66,14 +47,10 @@ def get_or_set_download_preference():
         os.system('cls' if os.name == 'nt' else 'clear')
     choice = int(choice)
 
-    # Update the download_preference in the settings dictionary
+    # Save the updated download_preference back to the YAML file
+    settings = load_settings()
     settings['download_preference'] = choice
-
-    # Save the updated settings back to the YAML file
-    if not os.path.exists(CONFIG_PATH):
-        os.makedirs(CONFIG_PATH)
-    with open(SETTINGS_FILE, 'w') as f:
-        yaml.dump(settings, f)
+    save_settings(settings)
 
     return choice
 
@@ -88,7 +65,7 @@ def sanitize_attachment_name(name):
 def fetch_discord_channels(server_id):
     """Fetch the list of channels for a given server."""
     url = f"{BASE_URL}/api/v1/discord/channel/lookup/{server_id}"
-    response = requests.get(url)
+    response = http_client.get(url)
 
     if response.status_code != 200:
         print(f"Error: Received status code {response.status_code} for URL: {url}")
@@ -113,13 +90,35 @@ def get_post_folder_name(post):
 
 def fetch_discord_posts(channel_id, skip_value):
     """Fetch posts for a given channel."""
-    response = requests.get(f"{BASE_URL}/api/v1/discord/channel/{channel_id}?skip={skip_value}")
+    with get_metrics().stage('page_fetch'):
+        response = http_client.get(f"{BASE_URL}/api/v1/discord/channel/{channel_id}?skip={skip_value}")
     if response.status_code == 200:
+        get_metrics().count('pages_total', site='discord')
         return response.json()
     return []
 
 
-def save_content_to_txt(folder_name, content, embeds, post):
+def format_content_txt(content, embeds):
+    text = "[CONTENT]\n"
+    text += content
+    text += "\n"
+
+    if embeds:
+        for embed in embeds:
+            text += "[EMBED]\n"
+            for key, value in embed.items():
+                # If the value is a dictionary, we need to handle it differently
+                if isinstance(value, dict):
+                    text += f"{key.capitalize()}:\n"
+                    for sub_key, sub_value in value.items():
+                        text += f"  {sub_key.capitalize()}: {sub_value}\n"
+                else:
+                    text += f"{key.capitalize()}: {value}\n"
+    return text
+
+
+def save_content_to_txt(post_texts, folder_name, content, embeds, post):
+    """Queue the content file of a post on post_texts, unless it didn't change since it was saved."""
     if not isinstance(post, dict):
         print(f"Unexpected post format: {post}")
         return
@@ -130,58 +129,128 @@ def save_content_to_txt(folder_name, content, embeds, post):
 
     # Save post content and embed data to content.txt with date appended
     folder_path = os.path.join(folder_name, f"content_{sanitized_post_date}.txt")
-    with open(folder_path, 'w', encoding='utf-8') as f:
-        f.write("[CONTENT]\n")
-        f.write(content)
-        f.write("\n")
-
-        if embeds:
-            for embed in embeds:
-                f.write("[EMBED]\n")
-                for key, value in embed.items():
-                    # If the value is a dictionary, we need to handle it differently
-                    if isinstance(value, dict):
-                        f.write(f"{key.capitalize()}:\n")
-                        for sub_key, sub_value in value.items():
-                            f.write(f"  {sub_key.capitalize()}: {sub_value}\n")
-                    else:
-                        f.write(f"{key.capitalize()}: {value}\n")
+    post_texts.add(folder_path, ['discord', content, embeds], lambda _: format_content_txt(content, embeds))
 
 
-def scrape_discord_server(server_id):
-    stash_path = read_stash_path_from_yaml()
-    creators_list = fetch_creator_data()
-    artist_name = sanitize_filename(get_artist_name_from_id(server_id, creators_list))
+def _message_key(message_id):
+    """Discord message IDs are snowflakes that grow over time; IDs that aren't numbers can't be ordered."""
+    return int(message_id) if str(message_id).isdigit() else None
 
-    # If artist name is not found, default to server_id
-    artist_name_or_id = artist_name if artist_name else server_id
 
-    # Use stash_path from YAML file as the base directory
-    base_path = os.path.join(stash_path, "Creators", "Kemono", artist_name_or_id)
+def is_newer_message(message_id, than_id):
+    """True if message_id is newer than than_id (None). Unordered IDs count as newer unless they're equal."""
+    if than_id is None:
+        return True
+    key, than_key = _message_key(message_id), _message_key(than_id)
+    if key is None or than_key is None:
+        return str(message_id) != str(than_id)
+    return key > than_key
 
-    download_preference = get_or_set_download_preference()
 
-    channels = fetch_discord_channels(server_id)
-    for channel in channels:
-        print(f"Fetching posts from channel: {channel['name']}...\n")
-        channel_path = os.path.join(base_path, channel['name'])
+def _was_handled(message_id, crawl_top, crawl_bottom):
+    """True if message_id lies within the part of a channel an interrupted crawl already handled."""
+    if crawl_top is None or crawl_bottom is None:
+        return False
+    key, top, bottom = _message_key(message_id), _message_key(crawl_top), _message_key(crawl_bottom)
+    return None not in (key, top, bottom) and bottom <= key <= top
+
+
+def _cursor_before(message_id):
+    """A cursor that makes the next crawl go down to message_id again, or None if the ID can't be ordered."""
+    key = _message_key(message_id)
+    return str(key - 1) if key else None
+
 
-        skip_value = 0
+def crawl_channel(server_id, channel, base_path, download_preference, settings):
+    """
+    Fetch the messages of a channel newest first and queue their attachments
+    on the shared download pool, stopping at the newest message of the last
+    finished crawl. Once the downloads of a page have finished its progress
+    is saved in the stash ledger, so an interrupted crawl resumes where it was.
+
+    Like a Kemono post with filtered out files, a message whose files were
+    left out by the type or size filters or skipped for the disk limit
+    isn't complete: the finished crawl is recorded below the oldest such
+    message, so the next one fetches it again.
+    """
+    ledger = get_stash_ledger(settings['stash_path'])
+    download_pool = get_download_pool(settings)
+    dashboard = get_dashboard()
+    metrics = get_metrics()
+    # Messages saved on an earlier run aren't written again unless they changed
+    post_texts = PostTextWriter(ledger)
+    channel_path = os.path.join(base_path, channel['name'])
+
+    cursor = ledger.get_channel_cursor(server_id, channel['id'])
+    newest_id = cursor['newest_id']
+    resumed_top, resumed_bottom = cursor['crawl_top'], cursor['crawl_bottom']
+    crawl_top, skip_value = resumed_top, cursor['crawl_skip']
+    if resumed_top:
+        print(f"Resuming channel {channel['name']} at message {skip_value}")
+        # Start on the oldest handled message, so the first page shows whether the offsets moved
+        skip_value = max(0, skip_value - 1)
+    check_resume_offset = bool(resumed_bottom and skip_value)
+
+    # Pages whose downloads may still be running, as
+    # ({job: message ID}, IDs of messages with filtered files, oldest message ID, offset after the page)
+    pages_in_flight = deque()
+    all_successful = True
+    oldest_incomplete = None
+
+    def settle_pages(limit):
+        """Record the progress of finished pages, waiting until at most limit pages are in flight."""
+        nonlocal all_successful, oldest_incomplete
+        while pages_in_flight and (len(pages_in_flight) > limit or all(job.done() for job in pages_in_flight[0][0])):
+            jobs, incomplete, page_bottom, page_skip = pages_in_flight.popleft()
+            with metrics.stage('wait_for_downloads'):
+                all_successful = wait_for_jobs(jobs) and all_successful
+            # Skipped downloads (None) leave their message incomplete, just like the filters do
+            incomplete += [message_id for job, message_id in jobs.items()
+                           if job.exception() is None and job.result() is None]
+            for message_id in incomplete:
+                if oldest_incomplete is None or is_newer_message(oldest_incomplete, message_id):
+                    oldest_incomplete = message_id
+            # After a failed download or an incomplete message the progress stays before it,
+            # so a resumed crawl fetches that page again
+            if all_successful and oldest_incomplete is None:
+                ledger.save_channel_progress(server_id, channel['id'], crawl_top, page_bottom, page_skip)
+
+    try:
         last_post_id = None
         while True:
+            if download_pool.stopped:
+                # The disk limit was reached, the crawl resumes from the last saved page next time
+                all_successful = False
+                break
             posts = fetch_discord_posts(channel['id'], skip_value)
             if not posts:
                 break
 
+            if check_resume_offset:
+                if skip_value and is_newer_message(resumed_bottom, posts[0]['id']):
+                    # Messages were deleted since the crawl stopped, so the offset moved past the ones after it
+                    skip_value = max(0, skip_value - len(posts))
+                    continue
+                check_resume_offset = False
+
             current_last_post_id = posts[-1]['id']
 
             if last_post_id == current_last_post_id:
                 break  # Break the loop if the last post ID starts repeating
 
             last_post_id = current_last_post_id  # Update the last_post_id for the next iteration
-            skip_value += 10  # Increment skip value for the next batch
-
-            for post in posts:
+            skip_value += len(posts)  # Pages can be shorter or longer than expected, continue after this one
+
+            if crawl_top is None:
+                crawl_top = posts[0]['id']
+            # Messages come newest first, so everything from the first known one on was handled by an earlier crawl
+            new_posts = list(takewhile(lambda post: is_newer_message(post['id'], newest_id), posts))
+            reached_known = len(new_posts) < len(posts)
+            new_posts = [post for post in new_posts if not _was_handled(post['id'], resumed_top, resumed_bottom)]
+            dashboard.count('posts', len(new_posts))
+
+            post_files = []
+            for post in new_posts:
                 post_folder_name = get_post_folder_name(post)
                 post_folder_path = os.path.join(channel_path, post_folder_name)
 
@@ -192,93 +261,103 @@ def scrape_discord_server(server_id):
                 else:
                     post_date_prefix = ""
 
-                if not os.path.exists(post_folder_path):
-                    os.makedirs(post_folder_path)
+                os.makedirs(post_folder_path, exist_ok=True)
 
+                files = []
                 for attachment in post.get('attachments', []):
                     attachment_url = BASE_URL + attachment.get('path', '')
                     attachment_name = sanitize_attachment_name(post_date_prefix + attachment.get('name', ''))
                     if attachment_url and attachment_name:
-                        download_file(attachment_url, post_folder_path, attachment_name, BASE_URL, artist_name_or_id, channel['name'])
+                        files.append((attachment_url, post_folder_path, attachment_name))
+                post_files.append((post['id'], files))
+
+                with metrics.stage('post_text'):
+                    save_content_to_txt(post_texts, post_folder_path, post.get('content', ''), post.get('embed', {}), post)
+
+            # Only files that pass the type and size filters are downloaded
+            planned_files, _ = download_plan.plan_files([file for _, files in post_files for file in files],
+                                                        settings.file_filter)
+            planned_files = set(planned_files)
+            jobs, incomplete = {}, []
+            for message_id, files in post_files:
+                planned = [file for file in files if file in planned_files]
+                if len(planned) < len(files):
+                    incomplete.append(message_id)
+                for file_url, folder, file_name in planned:
+                    job = download_pool.submit(file_url, os.path.join(folder, file_name), file_download.download_file,
+                                               file_url, folder, file_name, settings, source=BASE_URL)
+                    jobs[job] = message_id
+            with metrics.stage('post_text'):
+                post_texts.flush()
+
+            # Keep fetching while the downloads run, but only a few pages ahead of them
+            pages_in_flight.append((jobs, incomplete, current_last_post_id, skip_value))
+            settle_pages(DISCORD_PAGES_AHEAD)
+
+            if reached_known:
+                break
+    finally:
+        # Even when the crawl breaks off, the pages whose downloads finished are recorded
+        settle_pages(0)
+
+    if all_successful and crawl_top is not None:
+        newest = crawl_top if is_newer_message(crawl_top, newest_id) else newest_id
+        if oldest_incomplete is not None:
+            # Without ordered IDs the cursor stays where it was, so every message is looked at again
+            newest = _cursor_before(oldest_incomplete) or newest_id
+        ledger.finish_channel_crawl(server_id, channel['id'], newest)
+    print(f"Finished fetching posts from channel: {channel['name']}\n")
+
+
+def scrape_discord_server(server_id):
+    # One settings snapshot is used for the whole server and handed to every download
+    settings = get_settings()
+    stash_path = settings['stash_path']
+    creators = get_creator_index("kemono")
+    artist_name = sanitize_filename(get_artist_name_from_id(server_id, creators) or '')
+
+    # If artist name is not found, default to server_id
+    artist_name_or_id = artist_name if artist_name else server_id
 
-                save_content_to_txt(post_folder_path, post.get('content', ''), post.get('embed', {}), post)
+    # Use stash_path from YAML file as the base directory
+    base_path = os.path.join(stash_path, "Creators", "Kemono", artist_name_or_id)
 
-        print(f"Finished fetching posts from channel: {channel['name']}\n")
+    download_preference = get_or_set_download_preference()
+
+    channels = fetch_discord_channels(server_id)
+    dashboard = get_dashboard()
+    dashboard.start()
+    dashboard.set_artist(artist_name_or_id, channel=f"{len(channels)} channels")
+    try:
+        # Channels are crawled at the same time, their requests still share the per-site rate limit
+        # and their files the download pool
+        with ThreadPoolExecutor(max_workers=max(1, settings['discord_channel_workers']),
+                                thread_name_prefix='discord') as executor:
+            crawls = {executor.submit(crawl_channel, server_id, channel, base_path, download_preference, settings):
+                      channel for channel in channels}
+            for crawl in as_completed(crawls):
+                try:
+                    crawl.result()
+                except Exception as e:
+                    print(f"Error fetching posts from channel {crawls[crawl]['name']}: {e}")
+    finally:
+        get_stash_ledger(stash_path).flush()
+        dashboard.stop()
+        save_metrics(settings)
 
     print(f"\n{'='*40}")
     print("Download complete!")
+    get_dedup_store(stash_path).report()
     print(f"{'='*40}\n")
 
     # Call save_to_kemono_favorites to save the data of the Discord server
-    creators_list = fetch_creator_data()
-    artist_data = next((item for item in creators_list if item['id'] == server_id), None)
+    artist_data = creators.get(server_id, 'discord') or creators.get(server_id)
     if artist_data:
         save_to_kemono_favorites(artist_data)
     else:
         print(f"Failed to find data for artist with server ID: {server_id}")
 
 
-def download_file(url, folder_name, file_name, artist_url, artist_name_or_id, channel):
-    
-    from download import is_file_type_allowed, check_disk_limit, load_settings
-    settings = load_settings()
-
-    # Check file type
-    if not is_file_type_allowed(file_name, settings['file_type_to_download'], settings['file_type_extensions']):
-        print(f"Skipping download: {file_name} is not a selected file type.")
-        return False
-
-    # Check if download would exceed disk limit
-    if not check_disk_limit():
-        print("Skipping download due to disk limit reached.")
-        return False
-
-    folder_path = os.path.join(folder_name, file_name)
-    temp_folder_path = os.path.join(folder_name, f"{file_name}.temp")
-
-    # If a temporary file exists, remove it to restart the download
-    if os.path.exists(temp_folder_path):
-        os.remove(temp_folder_path)
-
-    # If the final file exists, skip the download
-    if os.path.exists(folder_path):
-        print(f"Skipping download: {file_name} already exists")
-        return
-
-    response = requests.get(url, stream=True)
-    if response and response.status_code == 200:
-        total_size_in_bytes = int(response.headers.get('content-length', 0))
-                    # Convert settings to bytes for comparison
-        min_size_bytes = settings['minimum_file_size'] * 1024 * 1024
-        max_size_bytes = settings['maximum_file_size'] * 1024 * 1024
-
-        # Check if the file size is within the specified limits (0 means no limit)
-        if (settings['minimum_file_size'] > 0 and total_size_in_bytes < min_size_bytes) or \
-            (settings['maximum_file_size'] > 0 and total_size_in_bytes > max_size_bytes):
-            print(f"Skipping download: {file_name} does not meet size criteria.")
-            return False
-        
-        progress_bar = tqdm(total=total_size_in_bytes,
-                            unit='iB',
-                            unit_scale=True,
-                            leave=True,
-                            desc=file_name)
-
-        # Use a temporary file for the download process
-        with open(temp_folder_path, 'wb') as f:
-            for data in response.iter_content(1024):
-                progress_bar.update(len(data))
-                f.write(data)
-
-        progress_bar.close()
-
-        # Rename the temporary file to the final file name
-        os.rename(temp_folder_path, folder_path)
-
-        print(f"Finished downloading: {file_name} from {artist_url}")
-        clear_console(artist_name_or_id, channel)
-
-
 if __name__ == "__main__":
     SERVER_ID = "485244986854735874"  # Example ID
     scrape_discord_server(SERVER_ID)
\ No newline at end of file
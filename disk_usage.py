@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import atexit
+import threading
+from file_lock import locked
+from download_pool import get_download_pool
+from concurrent.futures import ThreadPoolExecutor
+
+LEDGER_FILE = os.path.join('Config', 'disk_usage.json')
+# Rescan the stash from scratch after this many days to pick up files
+# that were added or deleted outside of OfflineParty
+DEFAULT_RESCAN_DAYS = 7
+# Don't rewrite the ledger file more often than this (in seconds)
+SAVE_INTERVAL = 5
+
+
+def _scan_tree(path):
+    """Return the total size in bytes of every regular file below path."""
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_symlink():
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        total += _scan_tree(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return total
+
+
+def scan_folder_size(folder_path, max_workers=8):
+    """
+    Return the size in bytes of folder_path, walking its top-level
+    subfolders (one per site/artist) in parallel.
+    """
+    if not os.path.isdir(folder_path):
+        return 0
+
+    total = 0
+    subfolders = []
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        total += sum(executor.map(_scan_tree, subfolders))
+    return total
+
+
+class DiskUsageLedger:
+    """
+    Running total of the bytes stored below the Creators folder.
+
+    The total is seeded once by scanning the folder and saved to
+    Config/disk_usage.json; after that it is only adjusted as files are
+    written or removed, so checking it costs nothing. Downloads reserve
+    their expected size up front so concurrent downloads can't overshoot
+    the disk limit together. Other processes using the same file (see
+    --shard) have their changes merged in whenever it's saved.
+    """
+
+    def __init__(self, root, ledger_file=LEDGER_FILE, rescan_days=DEFAULT_RESCAN_DAYS):
+        self.root = os.path.abspath(root)
+        self.ledger_file = ledger_file
+        self.rescan_days = rescan_days
+        self._used = 0
+        # Bytes added since the last save, merged into the total in the file
+        self._unsaved = 0
+        self._reserved = 0
+        self._scanned_at = 0
+        self._last_save = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        data = {}
+        if os.path.exists(self.ledger_file):
+            try:
+                with open(self.ledger_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Could not read {self.ledger_file}, rescanning stash: {e}")
+
+        too_old = self.rescan_days and time.time() - data.get('scanned_at', 0) > self.rescan_days * 86400
+        if data.get('root') != self.root or too_old:
+            self.rescan()
+        else:
+            self._used = data.get('used_bytes', 0)
+            self._scanned_at = data['scanned_at']
+
+    def rescan(self):
+        """Recalculate the total from disk and save it."""
+        print("Calculating the size of your stash...")
+        used = scan_folder_size(self.root)
+        with self._lock:
+            self._used = used
+            self._unsaved = 0
+            self._scanned_at = time.time()
+        self.save(force=True, rescanned=True)
+
+    def save(self, force=False, rescanned=False):
+        with self._lock:
+            if not force and (not self._dirty or time.time() - self._last_save < SAVE_INTERVAL):
+                return
+            self._dirty = False
+            self._last_save = time.time()
+
+        os.makedirs(os.path.dirname(self.ledger_file) or '.', exist_ok=True)
+        with locked(self.ledger_file):
+            with self._lock:
+                used, unsaved = self._used, self._unsaved
+                self._unsaved = 0
+            if not rescanned:
+                # Start from the total in the file, which includes what other processes wrote
+                try:
+                    with open(self.ledger_file, 'r', encoding='utf-8') as f:
+                        saved = json.load(f)
+                    if saved.get('root') == self.root:
+                        used = max(0, saved.get('used_bytes', 0) + unsaved)
+                except (OSError, ValueError):
+                    pass
+            data = {
+                'root': self.root,
+                'used_bytes': used,
+                'scanned_at': self._scanned_at,
+                'updated_at': time.time(),
+            }
+            temp_file = f"{self.ledger_file}.{os.getpid()}.temp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(temp_file, self.ledger_file)
+
+        with self._lock:
+            # Keep what was added while the file was being written
+            self._used = used + self._unsaved
+
+    def used_bytes(self, include_reserved=True):
+        with self._lock:
+            return self._used + (self._reserved if include_reserved else 0)
+
+    def add(self, size):
+        """Account for size bytes written (or removed, if negative)."""
+        with self._lock:
+            self._used = max(0, self._used + size)
+            self._unsaved += size
+            self._dirty = True
+        self.save()
+
+    def reserve(self, size, limit_bytes):
+        """
+        Reserve size bytes for a download that is about to start. Returns
+        False if the file wouldn't fit under limit_bytes (0 means no limit).
+        """
+        with self._lock:
+            if limit_bytes and self._used + self._reserved + size > limit_bytes:
+                return False
+            self._reserved += size
+            return True
+
+    def commit(self, reserved, written):
+        """
+        Turn a reservation into the number of bytes actually written
+        (negative if a partial file was thrown away).
+        """
+        with self._lock:
+            self._reserved = max(0, self._reserved - reserved)
+            self._used = max(0, self._used + written)
+            self._unsaved += written
+            self._dirty = True
+        self.save()
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_disk_usage_ledger(root, rescan_days=DEFAULT_RESCAN_DAYS):
+    """Return the ledger for root, loading or seeding it on first use."""
+    root = os.path.abspath(root)
+    with _ledgers_lock:
+        if root not in _ledgers:
+            _ledgers[root] = DiskUsageLedger(root, rescan_days=rescan_days)
+        return _ledgers[root]
+
+
+def get_disk_usage(settings):
+    """
+    Return the usage ledger of the Creators folder, or None if there's no
+    disk limit and the ledger has never been created.
+    """
+    if not settings['disk_limit'] and not os.path.exists(LEDGER_FILE):
+        return None
+    creators_folder = os.path.join(settings['stash_path'], 'Creators')
+    return get_disk_usage_ledger(creators_folder, settings['disk_usage_rescan_days'])
+
+
+def check_disk_limit(settings):
+    disk_limit = settings['disk_limit']  # Fetch disk limit from settings
+
+    if disk_limit == 0 or 0.0:
+        return True  # Skip disk limit check if set to 0
+
+    # Space reserved by running downloads is already checked against the limit when it's reserved
+    current_size = get_disk_usage(settings).used_bytes(include_reserved=False) / (1024 * 1024)  # in MB
+    percentage_used = (current_size / disk_limit) * 100
+
+    if percentage_used >= 70:
+        print(f"\033[91mWarning: You are using {percentage_used:.2f}% of your disk limit.\033[0m")
+        if percentage_used >= 100 and get_download_pool(settings).stop():
+            # This runs on a download thread, so the crawl is asked to stop instead of exiting from here
+            print("You have reached or exceeded your disk limit. No more downloads will be started.")
+
+    return percentage_used < 100
+
+
+@atexit.register
+def _save_ledgers():
+    for ledger in list(_ledgers.values()):
+        try:
+            ledger.save(force=True)
+        except OSError:
+            pass
@@ -1,23 +1,39 @@
 import os
-import sys
 import time
-import json
-import yaml
+import random
 import requests
 import argparse
-import html2text
 import webbrowser
+import file_download
+import download_plan
+import http_client
+import creator_catalog
 import get_favorites
-from tqdm import tqdm
-from bs4 import BeautifulSoup
+import job_queue
+import stash_ledger
 from datetime import datetime
+from functools import partial
 from pathvalidate import sanitize_filename
+from download_pool import get_download_pool, wait_for_jobs
+from stash_ledger import get_stash_ledger
+from user_settings import load_settings, save_settings, get_settings
+from dedup_store import get_dedup_store
+from comment_scraper import CommentScraper
+from post_text import PostTextWriter
+from dashboard import get_dashboard
+from metrics import get_metrics, save_metrics
+from job_queue import get_job_queue
+from file_lock import locked
+from sharding import parse_shard, run_name
 from user_search import main as user_search
 from json_handling import lookup_and_save_user as save_artist_json
 from discord_download import scrape_discord_server as discord_download
 
 __version__ = "v1.4.6"
 
+# Checks in watch mode are moved by up to this fraction of the interval, so they don't all line up
+WATCH_JITTER = 0.2
+
 updates_available = False  # Variable to store whether updates are available
 first_run = True  # Variable to identify the first run
 
@@ -40,7 +56,7 @@ def check_for_updates():
     global updates_available  # Make updates_available a global variable
     try:
         url = "https://api.github.com/repos/enhanc3d/OfflineParty/releases/latest"
-        response = requests.get(url)
+        response = http_client.get(url)
         latest_version = response.json()['tag_name']
         
         if latest_version != __version__:
@@ -49,166 +65,6 @@ def check_for_updates():
         print(f"Could not check for updates: {e}")
 
 
-def clear_console(artist_name_id_or_url, channel_name=None):
-    if artist_name_id_or_url is None:
-        artist_name_id_or_url = "Unknown Artist"  # Add a default value
-    
-    os.system('cls' if os.name == 'nt' else 'clear')
-    
-    separator = '=' * (len(artist_name_id_or_url) + 24)
-    print(separator)
-    
-    if channel_name:
-        print(f"Downloading posts from: {artist_name_id_or_url} in channel: {channel_name}")
-    else:
-        print(f"Downloading posts from: {artist_name_id_or_url}")
-    
-    print(separator)
-
-
-def load_settings():
-    dir_path = 'Config'
-    file_name = 'user_settings.yaml'
-    file_path = os.path.join(dir_path, file_name)
-
-    # Default settings
-    settings = {
-        'stash_path': './',
-        'post_limit': 0,  # 0 downloads all posts from the artist, it's the default value
-        'disk_limit': 0,  # 0 disables the download limit. Expressed in MB
-        'download_preference' : 0,
-        'minimum_file_size' : 0,
-        'maximum_file_size' : 0,
-        'file_type_to_download' : ['Image', 'GIF', 'Video', 'Compressed', 'PSD', 'Other'],
-        'show_startup_logo' : 0,
-        'create_post_folder': True,
-        # File type extensions
-        'file_type_extensions' : {
-            'Image': [
-                '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.svg', 
-                '.webp', '.raw', '.heif', '.indd', '.ai', '.eps'
-            ],
-            'GIF': [
-                '.gif'
-            ],
-            'Video': [
-                '.mp4', '.avi', '.mov', '.wmv', '.flv', '.mkv', '.webm', 
-                '.m4v', '.mpg', '.mpeg', '.3gp', '.vob', '.swf'
-            ],
-            'Compressed': [
-                '.zip', '.rar', '.7z', '.tar', '.gz', '.bz2', '.xz', '.iso', '.tgz'
-            ],
-            'Audio': [
-                '.mp3', '.wav', '.aac', '.flac', '.ogg', '.m4a', '.wma', 
-                '.alac', '.amr'
-            ],
-            'PSD': [
-                '.psd'
-            ]
-        }
-
-    }
-
-    # Check if the directory exists, if not create it
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-
-    # Check if the YAML file exists, if not create it
-    if not os.path.exists(file_path):
-        save_settings(settings)
-
-    # Read the YAML file
-    with open(file_path, 'r', encoding='utf-8') as settings_file:
-        try:
-            loaded_settings = yaml.safe_load(settings_file)
-            settings.update(loaded_settings)
-        except yaml.YAMLError as e:
-            print(f"Error reading settings file: {e}")
-
-    return settings
-
-
-def save_settings(settings):
-    dir_path = 'Config'
-    file_name = 'user_settings.yaml'
-    file_path = os.path.join(dir_path, file_name)
-
-    # Check if the directory exists, if not create it
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-
-    with open(file_path, 'w', encoding='utf-8') as settings_file:
-        yaml.dump(settings, settings_file, default_flow_style=False)
-
-
-def is_file_type_allowed(file_name, allowed_types, file_type_extensions):
-    extension = os.path.splitext(file_name)[1].lower()
-
-    if 'Other' in allowed_types:
-        # If 'Other' is allowed, check that the extension is not in the listed types
-        if not any(extension in ext_list for ext_list in file_type_extensions.values()):
-            return True
-
-    for file_type, extensions in file_type_extensions.items():
-        if file_type in allowed_types and extension in extensions:
-            return True
-
-    return False
-
-
-def get_folder_size(folder_path):
-    total_size = 0
-    for dirpath, dirnames, filenames in os.walk(folder_path):
-        for f in filenames:
-            fp = os.path.join(dirpath, f)
-            # Skip if it is symbolic link
-            if not os.path.islink(fp):
-                total_size += os.path.getsize(fp)
-    return total_size // (1024 * 1024)  # convert bytes to MB
-
-
-def check_disk_limit():
-    settings = load_settings()
-    disk_limit = settings['disk_limit']  # Fetch disk limit from settings
-    creators_folder = os.path.join(settings['stash_path'], 'Creators')
-
-    if disk_limit == 0 or 0.0:
-        return True  # Skip disk limit check if set to 0
-
-    if os.path.exists(creators_folder):
-        current_size = get_folder_size(creators_folder)
-        percentage_used = (current_size / disk_limit) * 100
-
-        if percentage_used >= 70:
-            print(f"\033[91mWarning: You are using {percentage_used:.2f}% of your disk limit.\033[0m")
-            if percentage_used >= 100:
-                print("You have reached or exceeded your disk limit. Exiting.")
-                time.sleep(10)
-                sys.exit(1)
-
-        return percentage_used < 100
-
-    return True  # Return True if Creators folder doesn't exist yet
-
-
-def check_file_size_within_limit(file_size):
-    settings = load_settings()
-    disk_limit = settings['disk_limit']  # Fetch disk limit from settings in MB
-    creators_folder = os.path.join(settings['stash_path'], 'Creators')
-
-    if disk_limit == 0 or 0.0:
-        return True  # Skip disk limit check if set to 0
-
-    if os.path.exists(creators_folder):
-        current_size = get_folder_size(creators_folder)  # in MB
-        remaining_space = disk_limit - current_size  # in MB
-        file_size_mb = file_size / (1024 * 1024)  # Convert file size to MB
-
-        return file_size_mb <= remaining_space
-
-    return True  # Return True if Creators folder doesn't exist yet
-
-
 def settings_menu():
     settings = load_settings()  # Assume this function is defined elsewhere
     original_settings = settings.copy()  # Store the original settings for comparison
@@ -467,24 +323,6 @@ def read_user_txt_list():
         run_with_base_url(urls, artist_id_to_name, json_data)
 
 
-# Function to read downloaded posts list from .json file
-def read_downloaded_posts_list(platform_folder):
-    file_path = os.path.join(platform_folder, "downloaded_posts.json")
-    downloaded_posts = set()
-    
-    if os.path.exists(file_path):
-        with open(file_path, 'r', encoding='utf-8') as file:
-            downloaded_posts = set(json.load(file))
-    
-    return downloaded_posts
-
-# Function to write downloaded post IDs to .json file
-def write_to_downloaded_post_list(platform_folder, downloaded_posts):
-    file_path = os.path.join(platform_folder, "downloaded_posts.json")
-    with open(file_path, 'w', encoding='utf-8') as file:
-        json.dump(list(downloaded_posts), file, ensure_ascii=False, indent=4)
-
-
 def get_post_folder_name(post):
     # Get the post title and strip any whitespace or newline characters
     title = post.get('title', '').strip()
@@ -510,127 +348,90 @@ def sanitize_attachment_name(name):
     return sanitize_filename(name)
 
 
-def get_with_retry(url, retries=5, stream=False, timeout=30, delay=30):
-    for i in range(retries):
-        try:
-            response = requests.get(url, stream=stream, timeout=timeout)
-            response.raise_for_status()
-            return response
-        except (requests.exceptions.RequestException, requests.exceptions.Timeout) as e:
-            print(f"Failed to get {url}, attempt {i + 1}")
-            if i < retries - 1:
-                print(f"Waiting for {delay} seconds before retrying.")
-                time.sleep(delay)  # Wait for 'delay' seconds before the next retry
-            else:
-                print(f"Failed to download {url}, logging to errors.txt")
-                current_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Get the current date and time
-                try:
-                    with open("errors.txt", 'a') as error_file:
-                        error_line = f"{current_date} - {url} -- {str(e)}\n"  # Include the current date and time
-                        error_file.write(error_line)
-                except Exception as write_error:
-                    print(f"Could not write to errors.txt. Error: {write_error}")
-                return None  # Explicitly return None if all retries fail
-
-
-def download_file(url, folder_name, file_name, artist_url, artist_name):
-    # Load settings
-    settings = load_settings()
-
-    # Check file type
-    if not is_file_type_allowed(file_name, settings['file_type_to_download'], settings['file_type_extensions']):
-        print(f"Skipping download: {file_name} is not a selected file type.")
-        return False
-
-    # Check if download would exceed disk limit
-    if not check_disk_limit():
-        print("Skipping download due to disk limit reached.")
-        return False
-
+def get_with_retry(url, retries=5, stream=False, timeout=30, headers=None):
+    # Waiting between attempts (backoff, Retry-After, rate limits) is handled by http_client
     try:
-        folder_path = os.path.join(folder_name, file_name)
-        temp_folder_path = os.path.join(folder_name, file_name + ".temp")
-
-        # If a temporary file exists, remove it to restart the download
-        if os.path.exists(temp_folder_path):
-            os.remove(temp_folder_path)
-
-        # If the final file exists, skip the download
-        if os.path.exists(folder_path):
-            print(f"Skipping download: {file_name} already exists")
-            return True  # Indicate that download is not needed (file already exists)
-
-        response = get_with_retry(url, stream=True)
-        if response is None:  # Check for None returned by get_with_retry
-            return False  # Indicate download failure
-
-        if response and response.status_code == 200:
-            total_size_in_bytes = int(response.headers.get('content-length', 0))
-
-            # Convert settings to bytes for comparison
-            min_size_bytes = settings['minimum_file_size'] * 1024 * 1024
-            max_size_bytes = settings['maximum_file_size'] * 1024 * 1024
-
-            # Check if the file size is within the specified limits (0 means no limit)
-            if (settings['minimum_file_size'] > 0 and total_size_in_bytes < min_size_bytes) or \
-               (settings['maximum_file_size'] > 0 and total_size_in_bytes > max_size_bytes):
-                print(f"Skipping download: {file_name} does not meet size criteria.")
-                return False
-
-            progress_bar = tqdm(total=total_size_in_bytes,
-                                unit='iB',
-                                unit_scale=True,
-                                leave=True,
-                                desc=file_name)
-
-            # Use a temporary file for the download process
-            with open(temp_folder_path, 'wb') as f:
-                for data in response.iter_content(1024):
-                    progress_bar.update(len(data))
-                    f.write(data)
-
-            progress_bar.close()
-
-            # Rename the temporary file to the final file name
-            os.rename(temp_folder_path, folder_path)
-
-            if total_size_in_bytes != 0 and progress_bar.n != total_size_in_bytes:
-                print("ERROR, something went wrong")
-                return False
-
-            print(f"Finished downloading: {file_name} from {artist_url}")
-            clear_console(artist_name or artist_url)  # Use artist_name if available, otherwise use artist_url
-
-            return True  # Indicate download success
-        else:
-            return False  # Indicate download failure
-    except Exception as e:
-        print(f"An error occurred while downloading {file_name}: {str(e)}")
-        return False  # Indicate download failure
-
-
-def run_with_base_url(url_list, data, json_file):
-    if url_list is None or len(url_list) == 0:
+        response = http_client.get(url, retries=retries - 1, stream=stream, timeout=timeout, headers=headers)
+        response.raise_for_status()
+        return response
+    except requests.exceptions.RequestException as e:
+        print(f"Failed to download {url}, logging to errors.txt")
+        current_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Get the current date and time
+        try:
+            # Other workers (see --shard) may be logging to the same file
+            with locked("errors.txt"), open("errors.txt", 'a') as error_file:
+                error_line = f"{current_date} - {url} -- {str(e)}\n"  # Include the current date and time
+                error_file.write(error_line)
+        except Exception as write_error:
+            print(f"Could not write to errors.txt. Error: {write_error}")
+        return None  # Explicitly return None if all retries fail
+
+
+def download_file(url, folder_name, file_name, artist_url, artist_name, settings):
+    # A skipped file (None) leaves its post incomplete, so here it counts as not downloaded
+    return bool(file_download.download_file(url, folder_name, file_name, settings,
+                                            fetch=partial(get_with_retry, stream=True), source=artist_url))
+
+
+def submit_download(download_pool, file_url, folder, file_name, artist_url, artist_name, settings,
+                    queue=None, file_job_id=None):
+    """Queue download_file on the pool, recording the outcome on the job queue when file_job_id is given."""
+    job = download_pool.submit(file_url, os.path.join(folder, file_name),
+                               download_file, file_url, folder, file_name, artist_url, artist_name, settings)
+    if queue is not None and file_job_id is not None:
+        job.add_done_callback(
+            lambda future: queue.finish(file_job_id, future.exception() is None and future.result() is not False))
+    return job
+
+
+def run_with_base_url(url_list, data, json_file, run=None):
+    """
+    Download the posts of the artists in url_list. With run, the artists
+    are instead leased from that run of the job queue, which records every
+    queued page, post and file so an interrupted run resumes where it was.
+    """
+    queue = get_job_queue() if run else None
+    if queue:
+        artist_counts = queue.progress(run).get('artist', {})
+        total_artists = sum(artist_counts.values())
+        first_position = artist_counts.get('done', 0) + 1
+    else:
+        total_artists = len(url_list or [])
+        first_position = 1
+    if total_artists == 0 or (queue and first_position > total_artists):
         print("No URLs to process. Exiting function.")
+        if queue:
+            queue.finish_run(run)
         return
     processed_users = set()
     current_artist = None
     current_artist_url = None
-    previous_url = None
-    previous_artist_id = None
 
-    # Explicitly load settings within the function
-    settings = load_settings()
+    # One settings snapshot is used for the whole run and handed to every download
+    settings = get_settings()
     stash_path = settings.get('stash_path', '')  # If stash_path is not found, default to empty string
     post_limit = settings.get('post_limit', 0)  # Fetch the post limit from settings, default to 0 (download all)
 
     # Dictionary to keep track of the number of downloaded posts for each artist
     artist_post_count = {}
 
+    ledger = get_stash_ledger(stash_path)
+    # Comments are fetched in the background, separately from the posts and their files
+    comment_scraper = CommentScraper(ledger) if settings['scrape_comments'] else None
+    comment_refresh_days = settings['comment_refresh_days']
+    # Post texts that didn't change since the last run aren't converted or written again
+    post_texts = PostTextWriter(ledger)
+
+    # Progress of the whole run is shown on one dashboard instead of a progress bar per file
+    dashboard = get_dashboard()
+    dashboard.start()
+    metrics = get_metrics()
+    artist_jobs = queue.iter_leases(run) if queue else iter([None] * len(url_list))
     try:
         all_downloaded_posts = set()
 
-        for i, url in enumerate(tqdm(url_list, desc="Downloading pages...")):
+        for position, artist_job in enumerate(artist_jobs, start=first_position):
+            url = artist_job.key if artist_job else url_list[position - 1]
             url_parts = url.split("/")
             if len(url_parts) < 7:
                 print(f"Unexpected URL structure: {url}")
@@ -652,7 +453,7 @@ def run_with_base_url(url_list, data, json_file):
                 print(f"Artist ID {artist_id} not found in data.")
                 continue
 
-            clear_console(artist_name)
+            dashboard.set_artist(artist_name, position=position, total=total_artists)
 
             if service == 'Discord':
                 discord_download(artist_id)
@@ -664,143 +465,302 @@ def run_with_base_url(url_list, data, json_file):
 
             os.makedirs(platform_folder, exist_ok=True)
 
-            response = get_with_retry(url)
-            response_data = json.loads(response.text)
+            # Posts downloaded before the ledger existed are imported once from downloaded_posts.json
+            ledger.migrate_json(domain, service, artist_id, platform_folder)
+            download_pool = get_download_pool(settings)
+
+            # Posts come newest first, so a long run of known posts means the rest is already downloaded,
+            # unless the artist is due a full scan to catch posts that were added to the site later
+            known_posts_limit = settings['incremental_sync_known_posts']
+            full_scan = ledger.is_full_scan_due(domain, service, artist_id, settings['full_scan_interval_days'])
+            known_posts_in_a_row = 0
+            reached_last_page = True
+            page_failed = False
+
+            # After a crash, first finish the pages that were queued but not done, then continue after them
+            first_page_url = url
+            if artist_job:
+                for page_job_id, queued_posts in queue.unfinished_pages(artist_job):
+                    print(f"Resuming {len(queued_posts)} unfinished posts of {artist_name}")
+                    queued_posts = [(post_job_id, post_id, complete,
+                                     [submit_download(download_pool, file_url, folder, file_name, url, artist_name,
+                                                      settings, queue, file_job_id)
+                                      for file_job_id, file_url, folder, file_name in files])
+                                    for post_job_id, post_id, complete, files in queued_posts]
+                    finished_posts = []
+                    for post_job_id, post_id, complete, jobs in queued_posts:
+                        successful = wait_for_jobs(jobs)
+                        if successful and complete:
+                            ledger.mark_downloaded(domain, service, artist_id, post_id)
+                        finished_posts.append((post_job_id, successful))
+                    # The posts are only finished in the queue once the ledger has them on disk
+                    ledger.flush()
+                    for post_job_id, successful in finished_posts:
+                        queue.finish(post_job_id, successful)
+                    queue.finish(page_job_id)
+                last_offset = queue.last_page_offset(artist_job)
+                if last_offset is not None:
+                    first_page_url = f"{url}?o={last_offset + get_favorites.PAGE_SIZE}"
+
+            # Pages are fetched one at a time as they're processed, stopping at the first empty one
+            for page_url, response_data in get_favorites.iter_post_pages(first_page_url, fetch=get_with_retry):
+                if response_data is None:
+                    # The older pages weren't seen, so the artist is checked again next run
+                    print(f"Could not fetch {page_url}, {artist_name} will be checked again next time")
+                    page_failed = True
+                    break
+                if download_pool.stopped:
+                    # The disk limit was reached, so nothing of this page could be downloaded
+                    page_failed = True
+                    break
 
-            downloaded_post_list = read_downloaded_posts_list(platform_folder)
+                page_post_ids = [post.get('id') for post in response_data]
+                downloaded_post_list = ledger.filter_downloaded(domain, service, artist_id, page_post_ids)
+                comments_due = (ledger.comment_scans_due(domain, service, artist_id, page_post_ids, comment_refresh_days)
+                                if comment_scraper else set())
 
-            for post_num, post in enumerate(response_data, start=1):
-                post_id = post.get('id')
-                post_folder_name = get_post_folder_name(post)
-                if settings['create_post_folder']:
-                    post_folder_path = os.path.join(platform_folder, sanitize_filename(post_folder_name))
-                    os.makedirs(post_folder_path, exist_ok=True)
-                else:
-                    post_folder_path = platform_folder
+                # Posts to download on this page with their files, as (url, folder, file_name)
+                page_posts = []
+
+                for post_num, post in enumerate(response_data, start=1):
+                    post_id = post.get('id')
+                    post_folder_name = get_post_folder_name(post)
+                    if settings['create_post_folder']:
+                        post_folder_path = os.path.join(platform_folder, sanitize_filename(post_folder_name))
+                        os.makedirs(post_folder_path, exist_ok=True)
+                    else:
+                        post_folder_path = platform_folder
+
+                    base_url = "/".join(url.split("/")[:3])
+                    post_url = f"{base_url}/{service.lower()}/user/{artist_id.lower()}/post/{post['id']}"
+
+                    if post_id in all_downloaded_posts or post_id in downloaded_post_list:
+                        print(f"Skipping download: Post {post_id} already downloaded")
+                        dashboard.count('known_posts')
+                        known_posts_in_a_row += 1
+                        # Comments of downloaded posts are fetched if that never worked, or again after the refresh interval
+                        content_path = os.path.join(post_folder_path, "content.txt")
+                        if post_id in comments_due and os.path.exists(content_path):
+                            comment_scraper.submit(post_url, content_path, domain, service, artist_id, post_id)
+                        continue
 
-                base_url = "/".join(url.split("/")[:3])
+                    known_posts_in_a_row = 0
 
-                all_downloads_successful = True
+                    # If we've reached the post limit for this artist, skip further posts
+                    if post_limit > 0 and artist_post_count.get(artist_id, 0) >= post_limit:
+                        print(f"Reached post limit for {artist_name}. Skipping further posts.")
+                        break
 
-                if post_id in all_downloaded_posts or post_id in downloaded_post_list:
-                    print(f"Skipping download: Post {post_id} already downloaded")
-                    clear_console(artist_name)
-                    continue
+                    files = []
+                    for attachment in post.get('attachments', []):
+                        attachment_url = base_url + attachment.get('path', '')
+                        attachment_name = sanitize_attachment_name(attachment.get('name', ''))
+                        if attachment_url and attachment_name:
+                            files.append((attachment_url, post_folder_path, attachment_name))
+
+                    file_info = post.get('file')
+                    if file_info and 'name' in file_info and 'path' in file_info:
+                        file_url = base_url + file_info['path']
+                        file_name = sanitize_attachment_name(file_info['name'])
+                        if file_url and file_name:
+                            files.append((file_url, post_folder_path, file_name))
+
+                    page_posts.append((post, post_id, post_folder_path, post_url, files))
+                    dashboard.count('posts')
+
+                    username = url.split('/')[-1].split('?')[0]
+                    if username not in processed_users:
+                        if artist_name != current_artist:
+                            current_artist_url = url
+                        else:
+                            current_artist = artist_name
+                        processed_users.add(username)
+
+                    # Count queued posts so the limit isn't overshot while downloads are still running
+                    artist_post_count[artist_id] = artist_post_count.get(artist_id, 0) + 1
 
-                # If we've reached the post limit for this artist, skip further posts
+                # Filter the files of the whole page by type and size before any download starts
+                planned_files, _ = download_plan.plan_files(
+                    [file for post, post_id, folder, post_url, files in page_posts for file in files], settings.file_filter)
+                planned_files = set(planned_files)
+
+                # A post with filtered out files isn't complete, so it's checked again on the next run
+                page_files = [(post_id, [file for file in files if file in planned_files], files)
+                              for post, post_id, post_folder_path, post_url, files in page_posts]
+                page_job_id, file_jobs = None, {}
+                if artist_job:
+                    # Record the page before its downloads start, so a crash from here on resumes it
+                    page_offset = int(page_url.rsplit('?o=', 1)[1])
+                    page_job_id, file_jobs = queue.add_page(
+                        artist_job, page_offset,
+                        [(post_id, len(planned) == len(files), planned) for post_id, planned, files in page_files])
+
+                # Posts whose files have been queued, along with their download jobs
+                queued_posts = []
+                for post_id, planned, files in page_files:
+                    post_job_id, file_job_ids = file_jobs.get(post_id, (None, [None] * len(planned)))
+                    jobs = [submit_download(download_pool, file_url, folder, file_name, url, artist_name, settings,
+                                            queue, file_job_id)
+                            for (file_url, folder, file_name), file_job_id in zip(planned, file_job_ids)]
+                    queued_posts.append((post_id, post_job_id, jobs, len(planned) == len(files)))
+
+                # The files download in the background while the post texts are saved
+                with metrics.stage('post_text'):
+                    for post, post_id, post_folder_path, post_url, files in page_posts:
+                        save_content_to_txt(post_texts, post_folder_path, post.get('content', ''), post.get('embed', {}), post_url)
+                    post_texts.flush()
+
+                for post, post_id, post_folder_path, post_url, files in page_posts:
+                    if post_id in comments_due:
+                        comment_scraper.submit(post_url, os.path.join(post_folder_path, "content.txt"),
+                                               domain, service, artist_id, post_id)
+
+                # Once every download of a post has finished successfully, record the post in the ledger.
+                finished_posts = []
+                for post_id, post_job_id, jobs, complete in queued_posts:
+                    with metrics.stage('wait_for_downloads'):
+                        successful = wait_for_jobs(jobs)
+                    if successful and complete:
+                        ledger.mark_downloaded(domain, service, artist_id, post_id)
+                        all_downloaded_posts.add(post_id)
+                    if post_job_id is not None:
+                        finished_posts.append((post_job_id, successful))
+                if page_job_id is not None:
+                    # The posts are only finished in the queue once the ledger has them on disk,
+                    # otherwise a crash in between would lose them from both
+                    ledger.flush()
+                    for post_job_id, successful in finished_posts:
+                        queue.finish(post_job_id, successful)
+                    queue.finish(page_job_id)
+
+                # Stop paging once the post limit for this artist has been reached
                 if post_limit > 0 and artist_post_count.get(artist_id, 0) >= post_limit:
-                    print(f"Reached post limit for {artist_name}. Skipping further posts.")
+                    reached_last_page = False
                     break
 
-                for attachment in post.get('attachments', []):
-                    attachment_url = base_url + attachment.get('path', '')
-                    attachment_name = sanitize_attachment_name(attachment.get('name', ''))
-                    if attachment_url and attachment_name:
-                        response = download_file(attachment_url, post_folder_path, attachment_name, url, artist_name)
-                        # Pass artist_name to download_file
-                        if response is False:  # Check if download was unsuccessful
-                            all_downloads_successful = False  # Set the flag to false
-
-                file_info = post.get('file')
-                if file_info and 'name' in file_info and 'path' in file_info:
-                    file_url = base_url + file_info['path']
-                    file_name = sanitize_attachment_name(file_info['name'])
-                    if file_url and file_name:
-                        response = download_file(file_url, post_folder_path, file_name, url, artist_name)
-                        if response is False:  # Check if download was unsuccessful
-                            all_downloads_successful = False  # Set the flag to false
-
-                content = post.get('content', '')
-                post_url = f"{base_url}/{service.lower()}/user/{artist_id.lower()}/post/{post['id']}"
-                save_content_to_txt(post_folder_path, content, post.get('embed', {}), post_url)
-
-                username = url.split('/')[-1].split('?')[0]
-                if username not in processed_users:
-                    if artist_name != current_artist:
-                        current_artist_url = url
-                    else:
-                        current_artist = artist_name
-                    processed_users.add(username)
+                if not full_scan and known_posts_limit > 0 and known_posts_in_a_row >= known_posts_limit:
+                    print(f"{artist_name} is up to date, skipping older posts.")
+                    reached_last_page = False
+                    break
 
-                # After all downloads for this post are complete, add the post ID to downloaded posts and save to JSON.
-                if all_downloads_successful:
-                    downloaded_post_list.add(post_id)
-                    write_to_downloaded_post_list(platform_folder, downloaded_post_list)
-                    all_downloaded_posts.add(post_id)
+            if page_failed:
+                if download_pool.stopped:
+                    print("Stopping, the disk limit was reached")
+                    break
+                # Keeping the old 'updated' makes the next run look at this artist again
+                continue
 
-                    # Increment the post count for this artist
-                    artist_post_count[artist_id] = artist_post_count.get(artist_id, 0) + 1
+            if reached_last_page:
+                ledger.record_full_scan(domain, service, artist_id)
 
-            if previous_url is not None:
-                if artist_id != previous_artist_id or i == len(url_list) - 1:
-                    print("Saving artist to JSON")
-                    clear_console(artist_name)
-                    save_artist_json(previous_url)
-            else:
-                save_artist_json(url)
+            print("Saving artist to JSON")
+            save_artist_json(url)
 
-            previous_url = url
-            previous_artist_id = artist_id
+        if comment_scraper:
+            print("Waiting for the remaining comments...")
+            comment_scraper.wait()
+
+        if queue:
+            artist_counts = queue.progress(run).get('artist', {})
+            if artist_counts.get('leased'):
+                print(f"{artist_counts['leased']} artists are still leased by another process, "
+                      f"they're picked up by the next run if that process stopped")
+            elif not artist_counts.get('pending'):
+                queue.finish_run(run)
 
     except requests.exceptions.RequestException:
         return False
-
-
-def save_content_to_txt(folder_name, content, embed, post_url):
+    finally:
+        if queue:
+            # Hands back the artist that was being processed if the run stopped early
+            artist_jobs.close()
+        if comment_scraper:
+            comment_scraper.shutdown()
+        ledger.flush()
+        get_dedup_store(stash_path).report()
+        dashboard.stop()
+        save_metrics(settings)
+
+
+def format_content_txt(post_url, content_markdown, embed):
+    text = "[POST URL]\n"
+    text += f"{post_url}\n\n"
+    text += "[CONTENT]\n"
+    text += content_markdown
+    text += "\n"
+
+    if embed:
+        text += "[EMBED]\n"
+        for key, value in embed.items():
+            text += f"{key.capitalize()}: {value}\n"
+        text += "\n"
+    return text
+
+
+def save_content_to_txt(post_texts, folder_name, content, embed, post_url):
+    """
+    Queue the content.txt of a post on post_texts, which writes it on its
+    next flush() unless the post is unchanged. The [COMMENTS] section is
+    added afterwards by the comment scraper.
+    """
     folder_path = os.path.join(folder_name, "content.txt")
-    comment_section = ""
+    post_texts.add(folder_path, ['content.txt', post_url, content, embed],
+                   lambda content_markdown: format_content_txt(post_url, content_markdown, embed), html=content)
 
-    try:
-        # Fetch the HTML content from the post_url
-        response = requests.get(post_url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        # Extract comments
-        comments = soup.find_all('article', class_='comment')
-        comment_list = []
-
-        for comment in comments:
-            user = comment.find('a', class_='comment__name').text
-            message = comment.find('p', class_='comment__message').text
-            timestamp = comment.find('time', class_='timestamp').text
-
-            formatted_comment = f"{user} - {message} - {timestamp}"
-            comment_list.append(formatted_comment)
-
-        # Join comments with line breaks
-        comment_section = '\n'.join(comment_list)
-
-    except Exception as e:
-        print(f"Error fetching comments from {post_url}: {e}")
 
-    with open(folder_path, 'w', encoding='utf-8') as f:
-        f.write("[POST URL]\n")
-        f.write(f"{post_url}\n\n")
-        f.write("[CONTENT]\n")
-        f.write(html2text.html2text(content))
-        f.write("\n")
-
-        if embed:
-            f.write("[EMBED]\n")
-            for key, value in embed.items():
-                f.write(f"{key.capitalize()}: {value}\n")
-            f.write("\n")
-
-        if comment_section:
-            f.write("[COMMENTS]\n")
-            f.write(comment_section)
-            f.write("\n")
-
-
-def main(option):
+def main(option, shard=None):
+    """Download the favorites of option, only the artists of shard (i, N) if given."""
     options = [option] if option != "both" else ["kemono", "coomer"]
-    url_list = []
+    queue = get_job_queue()
 
     for option in options:
-        api_pages, json_data = get_favorites.main(option)
-        url_list.extend(api_pages)
-        artist_id_to_name = create_artist_id_to_name_mapping(json_data)
-        run_with_base_url(url_list, artist_id_to_name, json_data)
+        if get_download_pool().stopped:
+            break  # The disk limit was reached
+        run = run_name(option, shard)
+        # An interrupted run continues from the job queue instead of walking the favorites again
+        artist_id_to_name = queue.get_run(run)
+        if artist_id_to_name is None:
+            artist_urls, json_data = get_favorites.main(option, shard)
+            artist_id_to_name = create_artist_id_to_name_mapping(json_data)
+            queue.start_run(run, [(artist_url, {}) for artist_url in artist_urls], artist_id_to_name)
+        else:
+            artists_left = sum(count for state, count in queue.progress(run).get('artist', {}).items()
+                               if state != 'done')
+            print(f"Resuming the unfinished {option.capitalize()} run, {artists_left} artists left")
+        run_with_base_url(None, artist_id_to_name, None, run=run)
+
+
+def watch(option, shard=None, interval_minutes=15):
+    """
+    Download the favorites of option again every interval_minutes, until
+    interrupted. Everything loaded along the way (creator lists, connections,
+    the download history) stays in memory between checks, and each check
+    only downloads the artists whose last update changed.
+    """
+    sites = [option] if option != "both" else ["kemono", "coomer"]
+    interval = interval_minutes * 60
+    # The sites are checked on their own schedules, the first ones spread out a little
+    next_check = {site: time.time() + index * random.uniform(0, WATCH_JITTER * interval)
+                  for index, site in enumerate(sites)}
+
+    while True:
+        site = min(next_check, key=next_check.get)
+        wait = next_check[site] - time.time()
+        if wait > 0:
+            print(f"Next check of {site.capitalize()} favorites at {datetime.fromtimestamp(next_check[site]):%H:%M:%S}")
+            time.sleep(wait)
+
+        try:
+            main(site, shard)
+        except Exception as e:
+            # A site being down shouldn't stop the watch, it's tried again next time
+            print(f"Checking {site.capitalize()} favorites failed: {e}")
+            with locked("errors.txt"), open("errors.txt", "a") as error_file:
+                error_file.write(f"{datetime.now():%Y-%m-%d %H:%M:%S} - Watch check of {site} failed: {e}\n")
+        if get_download_pool().stopped:
+            print("Stopping the watch, the disk limit was reached")
+            return
+        next_check[site] = time.time() + interval * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
 
 
 def delete_json_file(filename):
@@ -819,9 +779,12 @@ def delete_json_file(filename):
 if __name__ == "__main__":
     get_favorites.create_config("Config")
     os.system('cls' if os.name == 'nt' else 'clear')
-    settings = load_settings()
-    if settings['show_startup_logo']: display_ascii_art()
-    check_for_updates()
+    settings = get_settings()
+    creator_catalog.configure(ttl_hours=settings['creator_catalog_ttl_hours'])
+    # Keep at least one pooled connection per concurrent download
+    http_client.configure(pool_maxsize=max(http_client.DEFAULT_POOL_MAXSIZE, settings['max_concurrent_downloads']),
+                          requests_per_second=settings['requests_per_second'],
+                          retries=settings['max_retries'])
     parser = argparse.ArgumentParser(description="Download data from websites.")
     group = parser.add_mutually_exclusive_group()  # Removed required=True
     group.add_argument('-k', '--kemono', action='store_true', help="Download data from Kemono")
@@ -831,11 +794,39 @@ if __name__ == "__main__":
     group.add_argument('-l', '--list', action='store_true', help="Read usernames from user_list.txt")
 
     parser.add_argument('-r', '--reset', action='store_true', help="Reset JSON file for selected flag")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Only print JSON status lines, e.g. for cron jobs")
+    parser.add_argument('--shard', type=parse_shard, metavar='I/N',
+                        help="Only download the favorites of worker I out of N, run one process per shard")
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help="Keep running and check the favorites of -k, -c or -b again every watch_interval_minutes")
 
     args = parser.parse_args()
+    if args.watch and not (args.kemono or args.coomer or args.both):
+        parser.error("-w/--watch needs -k, -c or -b")
+    # Watch mode runs unattended, so the logo pause and update check are left out
+    if not args.watch:
+        if settings['show_startup_logo']: display_ascii_art()
+        check_for_updates()
+    get_dashboard().configure(quiet=args.quiet)
+    if args.shard or settings['shared_stash']:
+        # Other workers use the same ledger, so changes are committed right away instead of in batches
+        stash_ledger.configure(commit_batch_size=1)
+    if settings['shared_stash']:
+        # SQLite's WAL mode needs memory shared between the processes, which machines on a network share don't have
+        stash_ledger.configure(journal_mode='DELETE')
+        job_queue.configure(journal_mode='DELETE')
+
+    def run_favorites(option):
+        if not args.watch:
+            main(option, args.shard)
+            return
+        try:
+            watch(option, args.shard, settings['watch_interval_minutes'])
+        except KeyboardInterrupt:
+            print("Stopped watching")
 
 
-    if not any(vars(args).values()):  # Check if any arguments were provided
+    if not any(value for name, value in vars(args).items() if name not in ('quiet', 'shard', 'watch')):  # Check if any arguments were provided
         while True:
             os.system('cls' if os.name == 'nt' else 'clear')
             menu_title = "Main Menu"
@@ -867,11 +858,11 @@ if __name__ == "__main__":
             choice = input("Enter your choice: ")
 
             if choice == '1':
-                main("kemono")
+                main("kemono", args.shard)
             elif choice == '2':
-                main("coomer")
+                main("coomer", args.shard)
             elif choice == '3':
-                main("both")
+                main("both", args.shard)
             elif choice == '4':
                 users = input("Enter usernames or URLs, separated by commas: ").split(',')
                 users = [user.strip() for user in users]
@@ -905,11 +896,13 @@ if __name__ == "__main__":
         elif args.kemono:
             if args.reset:
                 delete_json_file('Config/kemono_favorites.json')
-            main("kemono")
+                get_job_queue().finish_run(run_name("kemono", args.shard))  # Start over instead of resuming an interrupted run
+            run_favorites("kemono")
         elif args.coomer:
             if args.reset:
                 delete_json_file('Config/coomer_favorites.json')
-            main("coomer")
+                get_job_queue().finish_run(run_name("coomer", args.shard))  # Start over instead of resuming an interrupted run
+            run_favorites("coomer")
         elif args.user:
             for user in users:  # Loop over the list of usernames
                 url, username, json_data = user_search(user)
@@ -919,4 +912,6 @@ if __name__ == "__main__":
             if args.reset:
                 delete_json_file('Config/kemono_favorites.json')
                 delete_json_file('Config/coomer_favorites.json')
-            main("both")
+                get_job_queue().finish_run(run_name("kemono", args.shard))
+                get_job_queue().finish_run(run_name("coomer", args.shard))
+            run_favorites("both")
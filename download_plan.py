@@ -0,0 +1,102 @@
+import os
+import http_client
+from dashboard import get_dashboard
+from metrics import get_metrics
+from concurrent.futures import ThreadPoolExecutor
+
+# HEAD requests sent at once to learn file sizes before downloading
+HEAD_WORKERS = 8
+
+
+def compile_extension_map(file_type_extensions):
+    """Return {extension: set of file types} for the extension lists in the settings."""
+    extension_map = {}
+    for file_type, extensions in file_type_extensions.items():
+        for extension in extensions:
+            extension_map.setdefault(extension.lower(), set()).add(file_type)
+    return extension_map
+
+
+class FileFilter:
+    """
+    The file type and size filters of the settings, compiled once so
+    every check is a set lookup instead of a scan over the extension lists.
+    """
+
+    def __init__(self, settings):
+        allowed_types = set(settings['file_type_to_download'])
+        extension_map = compile_extension_map(settings['file_type_extensions'])
+        self.allow_other = 'Other' in allowed_types
+        self.known_extensions = frozenset(extension_map)
+        self.allowed_extensions = frozenset(extension for extension, file_types in extension_map.items()
+                                            if file_types & allowed_types)
+        # 0 means no limit
+        self.min_size = int(settings['minimum_file_size'] * 1024 * 1024)
+        self.max_size = int(settings['maximum_file_size'] * 1024 * 1024)
+
+    def allows_type(self, file_name):
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension in self.allowed_extensions:
+            return True
+        # Files of a type that isn't listed anywhere fall under 'Other'
+        return self.allow_other and extension not in self.known_extensions
+
+    @property
+    def checks_size(self):
+        return self.min_size > 0 or self.max_size > 0
+
+    def allows_size(self, size):
+        """Unknown sizes (None) pass, the download checks them once it starts."""
+        if size is None:
+            return True
+        return not ((self.min_size > 0 and size < self.min_size) or (self.max_size > 0 and size > self.max_size))
+
+
+def _head_size(url):
+    try:
+        response = http_client.head(url)
+        response.raise_for_status()
+        return int(response.headers['content-length'])
+    except Exception:
+        return None
+
+
+def fetch_sizes(urls, max_workers=HEAD_WORKERS):
+    """Return {url: size in bytes or None} using concurrent HEAD requests."""
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+        return dict(zip(urls, executor.map(_head_size, urls)))
+
+
+def plan_files(files, file_filter):
+    """
+    Filter files, a list of (url, folder, file_name), down to the ones that
+    should be downloaded. The type is checked from the name; when a size
+    limit is set, the sizes of files that aren't on disk yet are fetched
+    with HEAD requests first so no download is started only to be dropped.
+    Returns the kept files and the number that were filtered out.
+    """
+    kept = []
+    for url, folder, file_name in files:
+        if file_filter.allows_type(file_name):
+            kept.append((url, folder, file_name))
+        else:
+            print(f"Skipping download: {file_name} is not a selected file type.")
+            get_dashboard().count('skipped', reason='type')
+
+    if file_filter.checks_size:
+        with get_metrics().stage('size_check'):
+            sizes = fetch_sizes(url for url, folder, file_name in kept
+                                if not os.path.exists(os.path.join(folder, file_name)))
+        planned = []
+        for url, folder, file_name in kept:
+            if file_filter.allows_size(sizes.get(url)):
+                planned.append((url, folder, file_name))
+            else:
+                print(f"Skipping download: {file_name} does not meet size criteria.")
+                get_dashboard().count('skipped', reason='size')
+        kept = planned
+
+    return kept, len(files) - len(kept)
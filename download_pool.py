@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from metrics import get_metrics
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Defaults used when user_settings.yaml doesn't define the concurrency limits
+DEFAULT_MAX_CONCURRENT_DOWNLOADS = 4
+DEFAULT_MAX_DOWNLOADS_PER_HOST = 2
+
+
+class DownloadPool:
+    """
+    Bounded worker pool for file downloads.
+
+    Jobs are plain callables (normally download_file) that are run on a
+    fixed number of worker threads. On top of the global limit, each host
+    only gets a limited number of simultaneous transfers so a single
+    server isn't flooded with connections, and jobs writing to the same
+    destination file never run at the same time.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+                 per_host=DEFAULT_MAX_DOWNLOADS_PER_HOST):
+        self.max_workers = max(1, int(max_workers))
+        self.per_host = max(1, int(per_host))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix="download")
+        self._host_slots = {}
+        self._destination_locks = {}  # destination -> [lock, number of jobs using it]
+        self._waiting = 0
+        self._running = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _get_host_slot(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    def _acquire_destination(self, destination):
+        with self._lock:
+            entry = self._destination_locks.setdefault(destination, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def _release_destination(self, destination):
+        with self._lock:
+            entry = self._destination_locks[destination]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._destination_locks[destination]
+
+    def _run(self, url, destination, submitted_at, func, args, kwargs):
+        metrics = get_metrics()
+        metrics.observe('stage_seconds', time.perf_counter() - submitted_at, stage='download_queue_wait')
+        with self._lock:
+            self._waiting -= 1
+            self._running += 1
+        # Posts often list the same file as both 'file' and an attachment,
+        # so the second job has to wait and then find the finished file
+        self._acquire_destination(destination)
+        try:
+            host_slot = self._get_host_slot(url)
+            with metrics.stage('host_slot_wait'):
+                host_slot.acquire()
+            try:
+                with metrics.stage('file_download'):
+                    return func(*args, **kwargs)
+            finally:
+                host_slot.release()
+        finally:
+            self._release_destination(destination)
+            with self._lock:
+                self._running -= 1
+
+    @contextmanager
+    def extra_host_slots(self, url, wanted):
+        """
+        Take up to wanted more slots of url's host without waiting, for a
+        running job that wants more connections (a segmented download).
+        Yields how many it got; they're given back when the block ends.
+        """
+        host_slot = self._get_host_slot(url)
+        taken = 0
+        while taken < wanted and host_slot.acquire(blocking=False):
+            taken += 1
+        try:
+            yield taken
+        finally:
+            for _ in range(taken):
+                host_slot.release()
+
+    def submit(self, url, destination, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) as the download of url into destination
+        and return its Future.
+        """
+        with self._lock:
+            self._waiting += 1
+        return self._executor.submit(self._run, url, os.path.abspath(destination), time.perf_counter(),
+                                     func, args, kwargs)
+
+    def stop(self):
+        """
+        Tell the code queuing downloads to stop, e.g. once the disk limit is
+        reached. Jobs already queued still run. Returns False if it was
+        already stopped.
+        """
+        with self._lock:
+            if self._stopped.is_set():
+                return False
+            self._stopped.set()
+            return True
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def stats(self):
+        """Return the number of queued jobs that haven't started yet and of running ones."""
+        with self._lock:
+            return {'waiting': self._waiting, 'running': self._running}
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+def wait_for_jobs(futures):
+    """
+    Wait until every job has finished and return True only if all of them
+    succeeded. A job counts as failed if it returned False or raised.
+    """
+    if not futures:
+        return True
+
+    wait(futures)
+    all_successful = True
+    for future in futures:
+        try:
+            if future.result() is False:
+                all_successful = False
+        except Exception as e:
+            print(f"A download job failed: {e}")
+            all_successful = False
+    return all_successful
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool_stats():
+    """stats() of the download pool, or zeros if it hasn't been created."""
+    pool = _pool
+    return pool.stats() if pool else {'waiting': 0, 'running': 0}
+
+
+def get_download_pool(settings=None):
+    """
+    Return the process-wide download pool, creating it on first use with the
+    limits from user_settings.yaml ('max_concurrent_downloads' and
+    'max_downloads_per_host').
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            settings = settings or {}
+            _pool = DownloadPool(
+                settings.get('max_concurrent_downloads', DEFAULT_MAX_CONCURRENT_DOWNLOADS),
+                settings.get('max_downloads_per_host', DEFAULT_MAX_DOWNLOADS_PER_HOST),
+            )
+        return _pool
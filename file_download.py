@@ -0,0 +1,407 @@
+import os
+import re
+import json
+import threading
+import requests
+import http_client
+from functools import partial
+from contextlib import nullcontext
+from dashboard import get_dashboard
+from dedup_store import get_dedup_store
+from disk_usage import get_disk_usage, check_disk_limit
+from download_pool import get_download_pool
+from stream_writer import StreamWriter, preallocate
+from concurrent.futures import ThreadPoolExecutor
+
+# Times a broken transfer is resumed before giving up on the file
+RESUME_ATTEMPTS = 3
+# Progress of a segmented or preallocated download is saved after this many bytes (per segment)
+SEGMENT_SAVE_INTERVAL = 8 * 1024 * 1024
+
+# Errors after which a transfer can be picked up where it stopped
+TRANSIENT_ERRORS = (requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout)
+
+
+class RangeNotSupported(Exception):
+    """The server answered a Range request with something other than 206."""
+
+
+def default_fetch(url, headers=None, stream=True):
+    response = http_client.get(url, headers=headers, stream=stream)
+    response.raise_for_status()
+    return response
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(meta_path, meta):
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _parse_content_range(value):
+    """Return (start, total) from a 'bytes start-end/total' header, or None."""
+    match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', value or '')
+    if not match:
+        return None
+    total = int(match.group(2)) if match.group(2) != '*' else 0
+    return int(match.group(1)), total
+
+
+def split_segments(total_size, count):
+    """Split total_size bytes into count [start, end, downloaded] byte ranges."""
+    size = -(-total_size // count)
+    return [[start, min(start + size, total_size) - 1, 0] for start in range(0, total_size, size)]
+
+
+def _download_segments(url, temp_path, meta, meta_path, fetch, progress_bar, first_response=None,
+                       write_behind=False, extra_slots=None):
+    """
+    Download what is missing of every segment in meta['segments'] at the
+    same time, each over its own connection, writing them at their offset
+    in the preallocated temp_path. first_response, an open response for the
+    whole file, is read for the first segment instead of sending a request.
+    With extra_slots only as many segments run at once as it hands out
+    connections (plus the one the download already has), the rest follow.
+    """
+    lock = threading.Lock()
+    validator = meta.get('etag') or meta.get('last_modified')
+
+    def save_progress():
+        with lock:
+            _write_meta(meta_path, meta)
+
+    def download_segment(segment, response=None):
+        for attempt in range(RESUME_ATTEMPTS + 1):
+            start, end, done = segment
+            position = start + done
+            if position > end:
+                return
+
+            if response is None:
+                headers = {'Range': f'bytes={position}-{end}'}
+                if validator:
+                    headers['If-Range'] = validator
+                response = fetch(url, headers=headers)
+                if response is None:
+                    raise requests.exceptions.ConnectionError(f"Could not fetch bytes {position}-{end} of {url}")
+                content_range = _parse_content_range(response.headers.get('content-range'))
+                if response.status_code != 206 or content_range is None or content_range[0] != position:
+                    response.close()
+                    raise RangeNotSupported(url)
+
+            try:
+                with open(temp_path, 'r+b') as f:
+                    f.seek(position)
+                    unsaved = 0
+
+                    def on_progress(size):
+                        nonlocal unsaved
+                        segment[2] += size
+                        unsaved += size
+                        progress_bar.update(size)
+                        if unsaved >= SEGMENT_SAVE_INTERVAL:
+                            # Only bytes that reached the file may be recorded as done
+                            f.flush()
+                            save_progress()
+                            unsaved = 0
+
+                    remaining = end - position + 1
+                    written = StreamWriter(f, on_progress, write_behind).copy(response, limit=remaining)
+                if written < remaining:
+                    raise requests.exceptions.ChunkedEncodingError(f"Bytes {start}-{end} of {url} ended early")
+                return
+            except TRANSIENT_ERRORS:
+                if attempt == RESUME_ATTEMPTS:
+                    raise
+            finally:
+                # The first segment stops reading the full response early, so drop that connection
+                response.close()
+                response = None
+                save_progress()
+
+    segments = meta['segments']
+    with extra_slots(len(segments) - 1) if extra_slots else nullcontext(len(segments) - 1) as extra:
+        with ThreadPoolExecutor(max_workers=1 + extra) as executor:
+            futures = [executor.submit(download_segment, segment, first_response if i == 0 else None)
+                       for i, segment in enumerate(segments)]
+            for future in futures:
+                future.result()
+
+
+def download_to_file(url, file_path, fetch=default_fetch, min_size=0, max_size=0,
+                     disk_ledger=None, disk_limit=0, segment_threshold=0, segments=1,
+                     write_behind=False, extra_slots=None):
+    """
+    Download url to file_path through file_path + '.temp', resuming a
+    partial .temp file left by an earlier attempt with an HTTP Range request.
+    The ETag/Last-Modified of the first response is kept next to the
+    .temp file, so a file that changed on the server is downloaded again
+    from scratch instead of being stitched together.
+
+    Files of at least segment_threshold bytes (0 = never) are split into
+    `segments` byte ranges that are downloaded over separate connections
+    at once, if the server says it accepts Range requests. extra_slots(n)
+    is a context manager yielding how many of n more connections to the
+    host may be opened (see DownloadPool.extra_host_slots); without it every
+    segment gets one. The .temp file is preallocated when the size is
+    known, and write_behind moves the disk writes to their own thread.
+
+    min_size/max_size (bytes, 0 = no limit) skip files of the wrong size and
+    disk_ledger/disk_limit reserve space against the disk limit. fetch is
+    called as fetch(url, headers=...) and returns a response or None.
+    Returns True once the file is complete, None if it was skipped for its
+    size or the disk limit and False if it failed; the outcome is counted
+    on the dashboard.
+    """
+    dashboard = get_dashboard()
+    file_name = os.path.basename(file_path)
+    temp_path = file_path + '.temp'
+    meta_path = temp_path + '.json'
+
+    meta = _read_meta(meta_path)
+    if os.path.exists(temp_path) and (not meta or meta.get('url') != url):
+        # A .temp file from an older version or another URL can't be resumed
+        if disk_ledger:
+            disk_ledger.add(-os.path.getsize(temp_path))
+        _remove(temp_path)
+        meta = None
+    if not os.path.exists(temp_path):
+        meta = None
+    elif 'written' in meta:
+        # The program was killed while the .temp file was preallocated, so its size
+        # says nothing; cut it back to the bytes last saved as written and resume there
+        preallocated_size = os.path.getsize(temp_path)
+        with open(temp_path, 'r+b') as f:
+            f.truncate(meta['written'])
+        if disk_ledger:
+            disk_ledger.add(meta['written'] - preallocated_size)
+        del meta['written']
+        _write_meta(meta_path, meta)
+
+    on_disk_before = os.path.getsize(temp_path) if meta else 0
+    reserved = 0
+    # A file resumed from an earlier run already passed the size checks
+    size_checked = meta is not None
+    total_size = meta.get('size', 0) if meta else 0
+    progress_bar = None
+
+    try:
+        for attempt in range(RESUME_ATTEMPTS + 1):
+            response = None
+            if not (meta and meta.get('segments')):
+                offset = os.path.getsize(temp_path) if meta else 0
+                if total_size and offset >= total_size:
+                    break  # Everything was already downloaded last time
+
+                headers = {}
+                if offset:
+                    headers['Range'] = f'bytes={offset}-'
+                    validator = meta.get('etag') or meta.get('last_modified')
+                    if validator:
+                        headers['If-Range'] = validator
+
+                response = fetch(url, headers=headers)
+                if response is None:
+                    dashboard.count('failed')
+                    return False
+
+                if response.status_code == 206:
+                    content_range = _parse_content_range(response.headers.get('content-range'))
+                    if content_range is None or content_range[0] != offset:
+                        response.close()
+                        raise requests.exceptions.ContentDecodingError(f"Unexpected Content-Range for {url}")
+                    total_size = content_range[1] or total_size
+                elif response.status_code == 200:
+                    # The server ignored the range or the file changed, start from zero
+                    offset = 0
+                    total_size = int(response.headers.get('content-length', 0))
+                else:
+                    response.close()
+                    dashboard.count('failed')
+                    return False
+
+                if not size_checked:
+                    # Check if the file size is within the specified limits (0 means no limit)
+                    if (min_size > 0 and total_size < min_size) or (max_size > 0 and total_size > max_size):
+                        print(f"Skipping download: {file_name} does not meet size criteria.")
+                        response.close()  # Hand the connection back to the pool without reading the body
+                        dashboard.count('skipped', reason='size')
+                        return None
+
+                    # Reserve the space up front so parallel downloads can't overshoot the disk limit together
+                    if disk_ledger:
+                        if not disk_ledger.reserve(max(0, total_size - on_disk_before), disk_limit):
+                            print(f"Skipping download: {file_name} would exceed the disk limit.")
+                            response.close()
+                            dashboard.count('skipped', reason='disk_limit')
+                            return None
+                        reserved = max(0, total_size - on_disk_before)
+                    size_checked = True
+
+                if meta is None or offset == 0:
+                    meta = {
+                        'url': url,
+                        'size': total_size,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified'),
+                    }
+                    # Big files are fetched in parallel byte ranges when the server allows it
+                    if (segments > 1 and segment_threshold and total_size >= segment_threshold
+                            and response.headers.get('Accept-Ranges', '').lower() == 'bytes'):
+                        meta['segments'] = split_segments(total_size, segments)
+                        with open(temp_path, 'wb') as f:
+                            preallocate(f, total_size)
+                    _write_meta(meta_path, meta)
+
+            if progress_bar is None:
+                progress_bar = dashboard.transfer(file_name, total_size)
+
+            try:
+                if meta.get('segments'):
+                    progress_bar.set_progress(sum(segment[2] for segment in meta['segments']))
+                    _download_segments(url, temp_path, meta, meta_path, fetch, progress_bar, response, write_behind,
+                                       extra_slots)
+                else:
+                    progress_bar.set_progress(offset)
+                    with open(temp_path, 'ab' if offset else 'wb') as f:
+                        unsaved = 0
+
+                        def on_progress(size):
+                            nonlocal unsaved
+                            progress_bar.update(size)
+                            if 'written' not in meta:
+                                return
+                            unsaved += size
+                            if unsaved >= SEGMENT_SAVE_INTERVAL:
+                                # Only bytes that reached the file may be recorded as written
+                                f.flush()
+                                meta['written'] += unsaved
+                                _write_meta(meta_path, meta)
+                                unsaved = 0
+
+                        if not offset and total_size:
+                            # Until the file is cut back to what was written its size says nothing
+                            # about progress, so the written offset is kept in the meta file instead
+                            meta['written'] = 0
+                            _write_meta(meta_path, meta)
+                            preallocate(f, total_size)
+                        writer = StreamWriter(f, on_progress, write_behind)
+                        try:
+                            writer.copy(response)
+                        finally:
+                            if meta.pop('written', None) is not None:
+                                f.truncate(writer.written)
+                                _write_meta(meta_path, meta)
+                break
+            except RangeNotSupported:
+                # The ranges stopped working (or the file changed), download it in one piece
+                print(f"Server refused a byte range of {file_name}, downloading it in one piece")
+                segments = 1
+                meta = None
+                _remove(meta_path)
+            except TRANSIENT_ERRORS as e:
+                if attempt == RESUME_ATTEMPTS:
+                    raise
+                print(f"Connection lost while downloading {file_name}, resuming: {e}")
+        else:
+            dashboard.count('failed')
+            return False
+    finally:
+        if progress_bar is not None:
+            progress_bar.close()
+        # Whatever made it to disk, even a partial .temp file, counts towards the usage
+        if disk_ledger:
+            on_disk_now = os.path.getsize(temp_path) if os.path.exists(temp_path) else 0
+            disk_ledger.commit(reserved, on_disk_now - on_disk_before)
+
+    written = os.path.getsize(temp_path)
+    if total_size and written != total_size:
+        print(f"ERROR, something went wrong downloading {file_name}: got {written} of {total_size} bytes")
+        # Don't resume from a file that's longer than it should be
+        if written > total_size:
+            if disk_ledger:
+                disk_ledger.add(-written)
+            _remove(temp_path)
+            _remove(meta_path)
+        dashboard.count('failed')
+        return False
+
+    # Rename the temporary file to the final file name
+    os.replace(temp_path, file_path)
+    _remove(meta_path)
+    dashboard.count('downloaded')
+    return True
+
+
+def download_file(url, folder_name, file_name, settings, fetch=default_fetch, source=None):
+    """
+    Download url as folder_name/file_name with the limits in settings: a file
+    that is already there is kept, one with the same content elsewhere in the
+    stash is reused, and anything else goes through download_to_file.
+    source (the artist or server URL) is only used in the message printed
+    when it's done. Returns True once the file is on disk, None if it was
+    skipped and False if it failed; errors are counted as failures instead
+    of being raised into the crawl.
+    """
+    dashboard = get_dashboard()
+    # The file type and size were already checked when the downloads were planned
+    # Check if download would exceed disk limit
+    if not check_disk_limit(settings):
+        print("Skipping download due to disk limit reached.")
+        dashboard.count('skipped', reason='disk_limit')
+        return None
+
+    try:
+        folder_path = os.path.join(folder_name, file_name)
+        dedup = get_dedup_store(settings['stash_path'])
+
+        # If the final file exists, skip the download
+        if os.path.exists(folder_path):
+            print(f"Skipping download: {file_name} already exists")
+            dashboard.count('skipped', reason='exists')
+            dedup.remember(url, folder_path, verify=True)
+            return True
+
+        with dedup.claim(url):
+            # The same file may already be on disk for another post or site
+            if dedup.reuse(url, folder_path, get_disk_usage(settings)):
+                dashboard.count('reused')
+                return True
+
+            # A partial .temp file left by an earlier run is resumed instead of starting over
+            downloaded = download_to_file(url, folder_path, fetch=fetch,
+                                          min_size=settings.minimum_file_size_bytes,
+                                          max_size=settings.maximum_file_size_bytes,
+                                          disk_ledger=get_disk_usage(settings),
+                                          disk_limit=settings.disk_limit_bytes,
+                                          segment_threshold=settings.segment_threshold_bytes,
+                                          segments=settings['segments_per_file'],
+                                          write_behind=settings['write_behind'],
+                                          # The extra connections of a segmented download count against the host's limit
+                                          extra_slots=partial(get_download_pool(settings).extra_host_slots, url))
+            if downloaded:
+                dedup.remember(url, folder_path)
+
+        if downloaded:
+            print(f"Finished downloading: {file_name} from {source or url}")
+        return downloaded
+    except Exception as e:
+        print(f"An error occurred while downloading {file_name}: {str(e)}")
+        dashboard.count('failed')
+        return False
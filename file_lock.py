@@ -0,0 +1,53 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _thread_lock(lock_path):
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(lock_path, threading.Lock())
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock for path while the block runs, against other
+    threads and other processes, including ones on other machines when path
+    is on an NFS share (POSIX record locks go through the NFS lock manager).
+    The lock is taken on a separate path + '.lock' file, so path itself can
+    be replaced inside the block. Not reentrant.
+    """
+    lock_path = os.path.abspath(path) + '.lock'
+    # POSIX locks belong to the process, so threads of one process are kept apart separately
+    with _thread_lock(lock_path):
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, 'a+b') as f:
+            if fcntl:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        # Gives up with an OSError after trying for about 10 seconds
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.1)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.lockf(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
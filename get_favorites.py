@@ -1,9 +1,28 @@
 import os
-import time
 import json
+import threading
 import requests
+import http_client
+from file_lock import locked
+from sharding import in_shard
+from creator_index import get_creator_index
+from metrics import get_metrics
 import browser_cookie3
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of posts the API returns per page
+PAGE_SIZE = 50
+# Changed artists whose first page is fetched at the same time
+FIRST_PAGE_WORKERS = 8
+# First pages kept in memory at most, the ones after that are fetched again when they're needed
+PREFETCHED_PAGES_LIMIT = 500
+
+# First pages fetched while checking favorites, handed over to (and removed by) iter_post_pages
+_prefetched_pages = {}
+_prefetched_pages_lock = threading.Lock()
+# Session cookies read from the browser, reused until the site stops accepting them
+_session_cookies = {}
 
 
 def create_config(directory):
@@ -17,15 +36,17 @@ def create_config(directory):
 
     # Check if 'kemono_favorites.json' exists, and create it with an empty array if not
     kemono_file_path = os.path.join(directory, 'kemono_favorites.json')
-    if not os.path.exists(kemono_file_path):
-        with open(kemono_file_path, 'w', encoding='utf-8') as kemono_file:
-            json.dump([], kemono_file)
+    with locked(kemono_file_path):
+        if not os.path.exists(kemono_file_path):
+            with open(kemono_file_path, 'w', encoding='utf-8') as kemono_file:
+                json.dump([], kemono_file)
 
     # Check if 'coomer_favorites.json' exists, and create it with an empty array if not
     coomer_file_path = os.path.join(directory, 'coomer_favorites.json')
-    if not os.path.exists(coomer_file_path):
-        with open(coomer_file_path, 'w', encoding='utf-8') as coomer_file:
-            json.dump([], coomer_file)
+    with locked(coomer_file_path):
+        if not os.path.exists(coomer_file_path):
+            with open(coomer_file_path, 'w', encoding='utf-8') as coomer_file:
+                json.dump([], coomer_file)
 
 
 def fetch_json_data(option):
@@ -43,46 +64,45 @@ def fetch_json_data(option):
         return None
 
     for cookie_domain, favorites_json_url in [(cookie_domain, JSON_url)]:
-        browser_cookies = browser_cookie3.load()
-        session_id_cookie = next(
-            (
-                cookie.value
-                for cookie in browser_cookies
-                if cookie_domain in cookie.domain and cookie.name == 'session'
-            ),
-            None
-        )
+        session_id_cookie = _session_cookies.get(cookie_domain)
+        if session_id_cookie is None:
+            # Reading every browser's cookie store is slow, so it's only done once
+            browser_cookies = browser_cookie3.load()
+            session_id_cookie = next(
+                (
+                    cookie.value
+                    for cookie in browser_cookies
+                    if cookie_domain in cookie.domain and cookie.name == 'session'
+                ),
+                None
+            )
         if session_id_cookie is None:
             print("Failed to fetch session ID cookie.")
             continue
 
         headers = {'Authorization': session_id_cookie}
-        retry_attempts = 3
-        retry_delay = 10
-
-        for attempt in range(1, retry_attempts + 1):
-            try:
-                session = requests.Session()
-                session.cookies.set('session',
-                                    session_id_cookie,
-                                    domain=cookie_domain)
-                favorites_response = session.get(favorites_json_url,
-                                                 headers=headers)
-                favorites_response.raise_for_status()
-                return_value = favorites_response.json()
-
-                # debug -- print(f"Number of return values: {len(return_value)}")
-
-                return return_value
-            except requests.exceptions.RequestException as e:
-                print(e)
-                print(f"Server error, retrying in {retry_delay} seconds")
-                time.sleep(retry_delay)
-                retry_delay *= 3
 
-                if attempt == retry_attempts:
-                    print("Couldn't connect to the server, try again later.")
-                    continue
+        # Retries with backoff are handled by http_client
+        try:
+            http_client.set_cookie('session',
+                                   session_id_cookie,
+                                   domain=cookie_domain)
+            favorites_response = http_client.get(favorites_json_url,
+                                                 headers=headers)
+            if favorites_response.status_code in (401, 403):
+                # Logged out, the browser is read again next time
+                _session_cookies.pop(cookie_domain, None)
+            favorites_response.raise_for_status()
+            _session_cookies[cookie_domain] = session_id_cookie
+            return_value = favorites_response.json()
+
+            # debug -- print(f"Number of return values: {len(return_value)}")
+
+            return return_value
+        except requests.exceptions.RequestException as e:
+            print(e)
+            print("Couldn't connect to the server, try again later.")
+            continue
 
     print("Failed to fetch favorite users.")
     print("Make sure you are logged into %s website(s) and try again" % option)
@@ -104,8 +124,11 @@ def load_old_favorites_data(json_file):
     return old_favorites_data
 
 
-def fetch_favorite_artists(option):
+def fetch_favorite_artists(option, shard=None):
     create_config('Config')
+    # Pages left over from an earlier check (e.g. in watch mode) may be outdated by now
+    with _prefetched_pages_lock:
+        _prefetched_pages.clear()
 
     if option not in ["kemono", "coomer"]:
         print(f"Invalid option: {option}")
@@ -120,35 +143,30 @@ def fetch_favorite_artists(option):
     if not favorites_data:
         return [], []
 
-    api_url_list = []
-
     # Identify artists that are in old_favorites but not in the new favorites_data
-    missing_from_favorites = {k: v for k, v in old_favorites.items() if k not in [artist['id'] for artist in favorites_data]}
+    favorite_ids = {artist['id'] for artist in favorites_data}
+    missing_from_favorites = {k: v for k, v in old_favorites.items() if k not in favorite_ids}
 
     # Fetch all creators
-    all_creators_url = f"https://{option}.su/api/v1/creators.txt"
     try:
-        response = requests.get(all_creators_url)
-        response.raise_for_status()
-        all_creators_data = response.json()
-    except requests.exceptions.RequestException as e:
+        creators = get_creator_index(option)
+    except (requests.exceptions.RequestException, ValueError) as e:
         print(f"Error fetching data from website: {e}")
         return [], []
 
-    creators_dict = {creator['id']: creator for creator in all_creators_data}
-
-    for creator in all_creators_data:
-        if creator['id'] in missing_from_favorites:
+    for artist_id, old_artist in missing_from_favorites.items():
+        if creator := creators.get(artist_id, old_artist.get('service')):
             favorites_data.append(creator)
 
     # Check for new posts for all artists in favorites_data
-    for artist in tqdm(favorites_data, desc="Processing artists"):
+    changed_artist_urls = []
+    for artist in favorites_data:
         new_posts = False
         artist_id = artist['id']
 
         if artist_id in old_favorites:
             old_updated = old_favorites[artist_id]['updated']
-            updated = artist['updated'] if artist['updated'] else creators_dict.get(artist_id, {}).get('updated', None)
+            updated = artist['updated'] if artist['updated'] else (creators.get(artist_id, artist['service']) or {}).get('updated', None)
             new_posts = old_updated != updated
         else:
             new_posts = True
@@ -156,45 +174,115 @@ def fetch_favorite_artists(option):
         if new_posts:
             service = artist['service']
             cookie_domain = f"{option}.su"
-            get_all_page_urls(cookie_domain, service, artist_id, api_url_list)
+            artist_url = get_artist_url(cookie_domain, service, artist_id)
+            # With --shard the other artists are left to the other workers
+            if in_shard(artist_url, shard):
+                changed_artist_urls.append(artist_url)
+
+    # Fetch the first page of every changed artist at the same time, keeping the favorites order
+    with ThreadPoolExecutor(max_workers=FIRST_PAGE_WORKERS) as executor:
+        has_posts = list(tqdm(executor.map(prefetch_first_page, changed_artist_urls),
+                              total=len(changed_artist_urls), desc="Processing artists"))
 
+    api_url_list = [url for url, keep in zip(changed_artist_urls, has_posts) if keep]
     return api_url_list, favorites_data
 
 
-def get_all_page_urls(cookie_domain, service, artist_id, api_url_list):
+def prefetch_first_page(artist_url):
+    """
+    Fetch the first page of an artist and keep it for iter_post_pages.
+    Returns False if the artist has no posts at all. Discord servers and
+    pages that couldn't be fetched are left for the download to handle.
+    """
+    if '/discord/channel/' in artist_url:
+        return True
+
+    page_url = f'{artist_url}?o=0'
+    try:
+        with get_metrics().stage('page_fetch'):
+            response = http_client.get(page_url)
+        if response.status_code != 200:
+            return True
+        posts = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return True
+
+    get_metrics().count('pages_total', site=artist_url.split('/')[2])
+    if not posts:
+        return False
+
+    with _prefetched_pages_lock:
+        # Artists are downloaded in favorites order, so the pages of the first ones are the ones worth keeping
+        if len(_prefetched_pages) < PREFETCHED_PAGES_LIMIT:
+            _prefetched_pages[page_url] = posts
+    return True
+
+
+def get_artist_url(cookie_domain, service, artist_id):
     """
-    Get all API page URLs for a specific artist.
+    Get the API URL of a specific artist. Its pages are fetched later,
+    while they're processed, with iter_post_pages.
     """
-    api_base_url = f'https://{cookie_domain}/api/v1/{service}/user/{artist_id}'
-    
     if service.lower() == "discord":
-        api_url_list.append(f'https://{cookie_domain}/api/v1/discord/channel/{artist_id}')
-        return api_url_list
-    
-    offset = 0
+        return f'https://{cookie_domain}/api/v1/discord/channel/{artist_id}'
+    return f'https://{cookie_domain}/api/v1/{service}/user/{artist_id}'
+
+
+def iter_post_pages(artist_url, fetch=http_client.get):
+    """
+    Yield (page_url, posts) for every page of an artist, newest posts first.
+    Each page is requested once (or taken from prefetch_first_page) and
+    paging stops at the first empty page. A page that couldn't be fetched
+    also ends it, but is yielded last as (page_url, None), so callers can
+    tell a failure apart from the end of the list.
+    If artist_url has an ?o= offset, paging starts there.
+    """
+    api_base_url, _, query = artist_url.partition('?')
+    offset = int(query[2:]) if query.startswith('o=') and query[2:].isdigit() else 0
+    site = api_base_url.split('/')[2]
+    metrics = get_metrics()
+
     while True:
-        api_url = f'{api_base_url}?o={offset}'
-        response = requests.get(api_url)
-        if response.status_code != 200 or not response.json():
+        page_url = f'{api_base_url}?o={offset}'
+        with _prefetched_pages_lock:
+            posts = _prefetched_pages.pop(page_url, None)
+        if posts is not None:
+            yield page_url, posts
+            offset += PAGE_SIZE
+            continue
+
+        with metrics.stage('page_fetch'):
+            response = fetch(page_url)
+        if response is None or response.status_code != 200:
+            yield page_url, None
             break
+        metrics.count('pages_total', site=site)
 
-        api_url_list.append(api_url)
-        offset += 50
+        try:
+            posts = response.json()
+        except ValueError:
+            print(f"Error decoding JSON from URL: {page_url}")
+            yield page_url, None
+            break
+        if not posts:
+            break
 
-    return api_url_list
+        yield page_url, posts
+        offset += PAGE_SIZE
 
 
-def main(option):
+def main(option, shard=None):
     """
-    Main function to fetch favorite artists.
+    Main function to fetch favorite artists, only the ones in shard (i, N) if given.
     """
-    api_pages_all_artists, favorites_data = fetch_favorite_artists(option)
-    # debug -- print(api_pages_all_artists)
-    return api_pages_all_artists, favorites_data
+    with get_metrics().stage('favorites'):
+        artist_urls, favorites_data = fetch_favorite_artists(option, shard)
+    # debug -- print(artist_urls)
+    return artist_urls, favorites_data
 
 
 if __name__ == "__main__":
-    api_pages_all_artists = main("coomer")
+    artist_urls = main("coomer")
     # DEBUG
-    # for api_page in api_pages_all_artists:
-    #     print(api_page)
+    # for artist_url in artist_urls:
+    #     print(artist_url)
@@ -0,0 +1,183 @@
+import time
+import threading
+import requests
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from metrics import get_metrics
+from rate_limiter import RateLimiter, CircuitOpenError, parse_retry_after, backoff_delay
+
+# Connect and read timeouts in seconds, used unless a caller passes its own
+DEFAULT_TIMEOUT = (10, 60)
+# Number of hosts that keep their own connection pool
+DEFAULT_POOL_CONNECTIONS = 16
+# Keep-alive connections kept open per host
+DEFAULT_POOL_MAXSIZE = 16
+
+# Retries after the first attempt for failed requests and 429/5xx answers
+DEFAULT_RETRIES = 4
+# Longest wait between two attempts, in seconds
+MAX_BACKOFF = 60
+# Answers that mean "try again later"
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'OfflineParty (+https://github.com/enhanc3d/OfflineParty)',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+}
+
+_session = None
+_session_lock = threading.Lock()
+_timeout = DEFAULT_TIMEOUT
+_pool_connections = DEFAULT_POOL_CONNECTIONS
+_pool_maxsize = DEFAULT_POOL_MAXSIZE
+_retries = DEFAULT_RETRIES
+_rate_limiter = RateLimiter()
+
+
+def _create_session():
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    adapter = HTTPAdapter(pool_connections=_pool_connections,
+                          pool_maxsize=_pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def configure(pool_maxsize=None, connect_timeout=None, read_timeout=None,
+              requests_per_second=None, retries=None):
+    """
+    Tune the shared transport. pool_maxsize should be at least the number
+    of downloads allowed to run against a single host at once, otherwise
+    extra connections are opened and thrown away instead of being reused.
+    Changing the pool size replaces the current session.
+    """
+    global _session, _timeout, _pool_maxsize, _retries, _rate_limiter
+    with _session_lock:
+        if retries is not None:
+            _retries = max(0, int(retries))
+        if requests_per_second is not None and requests_per_second != _rate_limiter.requests_per_second:
+            _rate_limiter = RateLimiter(requests_per_second)
+        if connect_timeout is not None or read_timeout is not None:
+            _timeout = (connect_timeout or _timeout[0], read_timeout or _timeout[1])
+        if pool_maxsize is not None and int(pool_maxsize) != _pool_maxsize:
+            _pool_maxsize = max(1, int(pool_maxsize))
+            if _session is not None:
+                cookies = _session.cookies
+                _session.close()
+                _session = _create_session()
+                _session.cookies.update(cookies)
+
+
+def get_session():
+    """
+    Return the process-wide requests.Session. Every module sends its
+    requests through it so TCP/TLS connections are kept alive and reused.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _create_session()
+        return _session
+
+
+def request(method, url, retries=None, **kwargs):
+    """
+    Send a request through the shared session, waiting for the per-host
+    rate limiter first. Connection errors and 429/5xx answers are retried
+    with exponential backoff (or as long as Retry-After asks); the last
+    response is returned as is, the last connection error is raised.
+    """
+    kwargs.setdefault('timeout', _timeout)
+    retries = _retries if retries is None else retries
+    host = urlparse(url).netloc
+    limiter = _rate_limiter.for_host(host)
+    session = get_session()
+    metrics = get_metrics()
+
+    for attempt in range(retries + 1):
+        last_attempt = attempt == retries
+        try:
+            with metrics.stage('rate_limit_wait'):
+                limiter.acquire()
+            started = time.perf_counter()
+            try:
+                response = session.request(method, url, **kwargs)
+            finally:
+                metrics.observe('http_request_seconds', time.perf_counter() - started, host=host)
+        except CircuitOpenError as e:
+            if last_attempt:
+                raise
+            metrics.count('http_retries_total', host=host, reason='circuit_open')
+            time.sleep(e.retry_in)
+            continue
+        except requests.exceptions.RequestException:
+            limiter.record_failure()
+            metrics.count('http_requests_total', host=host, status='error')
+            if last_attempt:
+                raise
+            metrics.count('http_retries_total', host=host, reason='connection')
+            time.sleep(backoff_delay(attempt, cap=MAX_BACKOFF))
+            continue
+
+        metrics.count('http_requests_total', host=host, status=str(response.status_code))
+        if response.status_code not in RETRY_STATUS_CODES:
+            limiter.record_success()
+            return response
+
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if response.status_code in THROTTLE_STATUS_CODES:
+            limiter.record_throttled(retry_after)
+        else:
+            limiter.record_failure()
+        if last_attempt:
+            return response
+
+        metrics.count('http_retries_total', host=host, reason=str(response.status_code))
+        response.close()
+        time.sleep(max(retry_after or 0, backoff_delay(attempt, cap=MAX_BACKOFF)))
+
+
+def get(url, **kwargs):
+    """Drop-in replacement for requests.get that uses the shared connection pools and rate limits."""
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    kwargs.setdefault('allow_redirects', True)
+    return request('HEAD', url, **kwargs)
+
+
+def set_cookie(name, value, domain):
+    """Store a cookie on the shared session, e.g. the Kemono/Coomer login session."""
+    get_session().cookies.set(name, value, domain=domain)
+
+
+def connection_stats():
+    """
+    Return how many requests were sent and how many TCP connections had to
+    be opened for them, per host and in total. 'reused' is the number of
+    requests that went over an already open connection.
+    """
+    session = get_session()
+    hosts = {}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.scheme}://{pool.host}"
+            stats = hosts.setdefault(host, {'requests': 0, 'connections': 0})
+            stats['requests'] += pool.num_requests
+            stats['connections'] += pool.num_connections
+
+    total = {'requests': 0, 'connections': 0}
+    for stats in hosts.values():
+        stats['reused'] = max(0, stats['requests'] - stats['connections'])
+        total['requests'] += stats['requests']
+        total['connections'] += stats['connections']
+    total['reused'] = max(0, total['requests'] - total['connections'])
+    return {'total': total, 'hosts': hosts}
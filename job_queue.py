@@ -0,0 +1,339 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+QUEUE_FILE = os.path.join('Config', 'job_queue.sqlite3')
+# An artist whose worker stopped renewing its lease for this long is handed out again
+LEASE_SECONDS = 60
+
+_journal_mode = 'WAL'
+
+
+def configure(journal_mode=None):
+    """Settings for queues opened from now on, journal_mode='DELETE' for a Config folder on a network share."""
+    global _journal_mode
+    if journal_mode is not None:
+        _journal_mode = journal_mode
+
+
+def _owner_is_gone(owner):
+    """True if owner is a process on this machine that no longer exists, so its leases can be taken over."""
+    host, _, rest = (owner or '').partition('/')
+    pid = rest.split('-')[0]
+    # os.kill(pid, 0) would interrupt the process on Windows, there the lease has to expire instead
+    if host != socket.gethostname() or not pid.isdigit() or os.name == 'nt':
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+class Job:
+    def __init__(self, job_id, key, payload):
+        self.id = job_id
+        self.key = key
+        self.payload = payload
+
+
+class JobQueue:
+    """
+    Durable work queue of a download run, kept in Config/job_queue.sqlite3.
+
+    A run (e.g. 'kemono') is a list of artist jobs. Every page of an
+    artist that has been queued for download is recorded under it, with a
+    job for each of its posts and for each file of those posts, so after a
+    crash the run continues with the artists that weren't finished, the
+    files that were still downloading and the pages after the last queued
+    one, instead of walking every favorite again.
+
+    Artists are leased by the worker that processes them and the lease is
+    renewed while it works; pages, posts and files belong to the lease of
+    their artist. Jobs go from 'pending' (or 'leased') to 'done' or 'failed'.
+    """
+
+    def __init__(self, db_path=QUEUE_FILE):
+        self.db_path = db_path
+        self.owner = f"{socket.gethostname()}/{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._lock = threading.RLock()
+        # Writes are committed right away (autocommit), so nothing is lost in a crash
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute(f"PRAGMA journal_mode={_journal_mode}")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    name TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    started_at REAL NOT NULL
+                )
+            """)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    parent INTEGER,
+                    key TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    lease_owner TEXT,
+                    lease_until REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    UNIQUE (run, kind, key)
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS idx_jobs_parent ON jobs (parent)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS idx_jobs_run_state ON jobs (run, kind, state)")
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    # Runs
+
+    def get_run(self, name):
+        """Return the data saved with the unfinished run name, or None if there's none."""
+        with self._lock:
+            row = self._connection.execute("SELECT data FROM runs WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def start_run(self, name, artists, data=None):
+        """
+        Start the run name over with one artist job per (key, payload) in
+        artists, dropping whatever was left of an earlier one. data is
+        kept with the run and returned by get_run.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM jobs WHERE run = ?", (name,))
+            connection.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?)", (name, json.dumps(data or {}), now))
+            connection.executemany(
+                "INSERT OR IGNORE INTO jobs (run, kind, key, payload, updated_at) VALUES (?, 'artist', ?, ?, ?)",
+                [(name, key, json.dumps(payload), now) for key, payload in artists],
+            )
+
+    def finish_run(self, name):
+        """Forget a run whose artists are all done, the next one starts from scratch."""
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM jobs WHERE run = ?", (name,))
+            connection.execute("DELETE FROM runs WHERE name = ?", (name,))
+
+    def progress(self, name):
+        """Return {kind: {state: count}} for the jobs of a run."""
+        counts = {}
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT kind, state, COUNT(*) FROM jobs WHERE run = ? GROUP BY kind, state", (name,)
+            )
+            for kind, state, count in rows:
+                counts.setdefault(kind, {})[state] = count
+        return counts
+
+    # Artists
+
+    def lease(self, name):
+        """
+        Lease the next artist of a run that is pending, or whose worker
+        died: its lease expired or its process is gone. Returns a Job or None.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute(
+                "SELECT id, key, payload FROM jobs WHERE run = ? AND kind = 'artist' "
+                "AND (state = 'pending' OR (state = 'leased' AND lease_until < ?)) ORDER BY id LIMIT 1",
+                (name, now),
+            ).fetchone()
+            if row is None:
+                # A crashed run on this machine doesn't have to wait for its leases to expire
+                for job_id, key, payload, owner in connection.execute(
+                        "SELECT id, key, payload, lease_owner FROM jobs WHERE run = ? AND kind = 'artist' "
+                        "AND state = 'leased' ORDER BY id", (name,)).fetchall():
+                    if _owner_is_gone(owner):
+                        row = (job_id, key, payload)
+                        break
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET state = 'leased', lease_owner = ?, lease_until = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE id = ?",
+                (self.owner, now + LEASE_SECONDS, now, row[0]),
+            )
+        return Job(row[0], row[1], json.loads(row[2]))
+
+    def iter_leases(self, name):
+        """
+        Yield the artists of a run one lease at a time until none are left.
+        An artist is finished when the next one is asked for; if the loop
+        stops early (the generator is closed) its lease is handed back.
+        """
+        while (job := self.lease(name)) is not None:
+            with self.keep_leased(job.id):
+                try:
+                    yield job
+                except GeneratorExit:
+                    self.release(job.id)
+                    raise
+            self.finish(job.id)
+
+    def renew(self, job_id):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND lease_owner = ?",
+                (now + LEASE_SECONDS, now, job_id, self.owner),
+            )
+
+    @contextmanager
+    def keep_leased(self, job_id):
+        """Renew the lease of job_id in the background while the block runs."""
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(LEASE_SECONDS / 3):
+                self.renew(job_id)
+
+        thread = threading.Thread(target=heartbeat, name='job-lease', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, job_id):
+        """Hand a leased job back so the next worker (or run) picks it up."""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET state = 'pending', lease_owner = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND state = 'leased'",
+                (time.time(), job_id),
+            )
+
+    def finish(self, job_id, ok=True):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET state = ?, lease_owner = NULL, lease_until = NULL, updated_at = ? WHERE id = ?",
+                ('done' if ok else 'failed', time.time(), job_id),
+            )
+
+    # Pages, posts and files of an artist
+
+    def add_page(self, artist_job, offset, posts):
+        """
+        Record a page of artist_job whose files are about to be downloaded.
+        posts is a list of (post_id, complete, files) with files as
+        (url, folder, file_name). Returns the page job ID and
+        {post_id: (post job ID, [file job IDs])}.
+        """
+        now = time.time()
+        name = self._run_of(artist_job)
+        jobs = {}
+        with self._transaction() as connection:
+            page_id = self._insert(connection, name, 'page', artist_job.id, f"{artist_job.id}:{offset}",
+                                   {'offset': offset}, now)
+            for post_id, complete, files in posts:
+                post_job_id = self._insert(connection, name, 'post', page_id, f"{artist_job.id}:{post_id}",
+                                           {'post_id': post_id, 'complete': complete}, now)
+                file_job_ids = [
+                    self._insert(connection, name, 'file', post_job_id, f"{post_job_id}:{os.path.join(folder, file_name)}",
+                                 {'url': url, 'folder': folder, 'file_name': file_name}, now)
+                    for url, folder, file_name in files
+                ]
+                jobs[post_id] = (post_job_id, file_job_ids)
+        return page_id, jobs
+
+    def _run_of(self, job):
+        with self._lock:
+            return self._connection.execute("SELECT run FROM jobs WHERE id = ?", (job.id,)).fetchone()[0]
+
+    @staticmethod
+    def _insert(connection, name, kind, parent, key, payload, now):
+        # A page queued again after a crash replaces its unfinished jobs instead of duplicating them
+        connection.execute(
+            "INSERT INTO jobs (run, kind, parent, key, payload, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (run, kind, key) DO UPDATE SET parent = excluded.parent, payload = excluded.payload, "
+            "state = 'pending', updated_at = excluded.updated_at",
+            (name, kind, parent, key, json.dumps(payload), now),
+        )
+        return connection.execute("SELECT id FROM jobs WHERE run = ? AND kind = ? AND key = ?",
+                                  (name, kind, key)).fetchone()[0]
+
+    def last_page_offset(self, artist_job):
+        """Return the offset of the last page of the artist that was queued, or None."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT payload FROM jobs WHERE kind = 'page' AND parent = ?", (artist_job.id,)
+            ).fetchall()
+        offsets = [json.loads(payload)['offset'] for payload, in rows]
+        return max(offsets) if offsets else None
+
+    def unfinished_pages(self, artist_job):
+        """
+        Return the pages of the artist that were queued but not finished, as
+        [(page job ID, [(post job ID, post_id, complete, [(file job ID, url, folder, file_name)])])]
+        with only the files that still have to be downloaded. Files that
+        failed before the crash are handed out again, so their post is only
+        recorded as downloaded once they succeed.
+        """
+        pages = []
+        with self._lock:
+            page_rows = self._connection.execute(
+                "SELECT id FROM jobs WHERE kind = 'page' AND parent = ? AND state = 'pending' ORDER BY id",
+                (artist_job.id,),
+            ).fetchall()
+            for page_id, in page_rows:
+                posts = []
+                post_rows = self._connection.execute(
+                    "SELECT id, payload FROM jobs WHERE kind = 'post' AND parent = ? AND state = 'pending' ORDER BY id",
+                    (page_id,),
+                ).fetchall()
+                for post_job_id, payload in post_rows:
+                    payload = json.loads(payload)
+                    files = []
+                    for file_job_id, file_payload in self._connection.execute(
+                            "SELECT id, payload FROM jobs WHERE kind = 'file' AND parent = ? "
+                            "AND state IN ('pending', 'failed') ORDER BY id", (post_job_id,)):
+                        file_payload = json.loads(file_payload)
+                        files.append((file_job_id, file_payload['url'], file_payload['folder'],
+                                      file_payload['file_name']))
+                    posts.append((post_job_id, payload['post_id'], payload['complete'], files))
+                pages.append((page_id, posts))
+        return pages
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Return the job queue of this process, opening Config/job_queue.sqlite3 on first use."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
@@ -1,12 +1,11 @@
 import re
 import json
-import requests
+from file_lock import locked
+from creator_index import get_creator_index
 
 
 # Look up the user in the provided data and save to the appropriate JSON file
 def lookup_and_save_user(url):
-    kemono_data = requests.get("https://kemono.su/api/v1/creators.txt").json()
-    coomer_data = requests.get("https://coomer.su/api/v1/creators.txt").json() 
     # Regular expression to extract domain, service, and user ID/name from URL
     pattern = r'https://(?P<domain>\w+\.(?:party|su))/api/v1/(?P<service>[\w/]+)/(?P<user_id>[\w\d]+)(\?o=\d+)?'
     if match := re.match(pattern, url):
@@ -17,14 +16,15 @@ def lookup_and_save_user(url):
         user_id = match.group('user_id')
 
         if domain in ["coomer.party", "coomer.su"]:
-            data = coomer_data
+            creators = get_creator_index("coomer")
         elif domain in ["kemono.party", "kemono.su"]:
-            data = kemono_data
+            creators = get_creator_index("kemono")
         else:
             print(f"No matching domain found for: {domain}")
             return
 
-        user_data = next((item for item in data if item.get('id') == user_id), None)
+        # service is e.g. "patreon/user" or "discord/channel"
+        user_data = creators.get(user_id, service.split('/')[0]) or creators.get(user_id)
 
         if user_data:
             # Save to the appropriate JSON file
@@ -40,7 +40,8 @@ def lookup_and_save_user(url):
 
 def save_to_coomer_favorites(data):
     """Save or update the provided user data in coomer_favorites.json."""
-    with open("Config/coomer_favorites.json", "r+") as file:
+    # Locked, as other workers (see --shard) update the same file
+    with locked("Config/coomer_favorites.json"), open("Config/coomer_favorites.json", "r+") as file:
         # Load the existing data
         existing_data = json.load(file)
 
@@ -63,7 +64,8 @@ def save_to_coomer_favorites(data):
 
 def save_to_kemono_favorites(data):
     """Save or update the provided user data in coomer_favorites.json."""
-    with open("Config/kemono_favorites.json", "r+", encoding='utf-8') as file:
+    # Locked, as other workers (see --shard) update the same file
+    with locked("Config/kemono_favorites.json"), open("Config/kemono_favorites.json", "r+", encoding='utf-8') as file:
         # Load the existing data
         existing_data = json.load(file)
 
@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# Upper bounds in seconds of the buckets of every latency histogram
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Prefix of the metric names in the Prometheus textfile
+PREFIX = 'offlineparty_'
+
+# name -> (type, help text) of every metric that's recorded
+METRICS = {
+    'http_requests_total': ('counter', "HTTP requests sent, by host and status code ('error' when no answer came)"),
+    'http_request_seconds': ('histogram', "Time until the answer of an HTTP request arrived, by host"),
+    'http_retries_total': ('counter', "HTTP requests that were sent again, by host and reason"),
+    'downloaded_bytes_total': ('counter', "Bytes of files downloaded"),
+    'files_total': ('counter', "Files by outcome (downloaded, reused, skipped, failed) and reason for skipping"),
+    'posts_total': ('counter', "Posts by result: new ones queued for download, known ones already downloaded"),
+    'pages_total': ('counter', "Pages of posts or Discord messages fetched, by site"),
+    'stage_seconds': ('histogram', "Time spent in each stage of a sync, summed over the threads doing it"),
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is above every bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                return
+        self.counts[-1] += 1
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) per bucket, ending with +Inf."""
+        total = 0
+        result = []
+        for bound, count in zip((*self.buckets, float('inf')), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _format_labels(labels, **extra):
+    labels = {**dict(labels), **extra}
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+class Metrics:
+    """
+    Counters and latency histograms of everything this process downloaded,
+    for finding out where the time of a sync goes.
+
+    Values only ever grow while the process runs (also across the checks
+    of watch mode), the way Prometheus expects counters to. They're written
+    as a Prometheus textfile (for node_exporter's textfile collector) and as
+    a JSON summary; see save_metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+        self.started_at = time.time()
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def stage(self, name):
+        """Add the time the block takes to stage name."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started, stage=name)
+
+    def summary(self):
+        """Everything recorded so far as a dict, with the total seconds per stage up front."""
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                           'sum': round(histogram.sum, 3),
+                           'buckets': {_format_bound(bound): count for bound, count in histogram.cumulative()}}
+                          for (name, labels), histogram in sorted(self._histograms.items())]
+        stages = {entry['labels']['stage']: entry['sum'] for entry in histograms if entry['name'] == 'stage_seconds'}
+        return {
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'updated_at': datetime.now().isoformat(timespec='seconds'),
+            'elapsed_seconds': round(time.time() - self.started_at, 1),
+            'stage_seconds': dict(sorted(stages.items(), key=lambda item: -item[1])),
+            'counters': counters,
+            'histograms': histograms,
+        }
+
+    def prometheus_text(self):
+        """Everything recorded so far in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in METRICS.items():
+                counters = sorted((labels, value) for (metric, labels), value in self._counters.items() if metric == name)
+                histograms = sorted((labels, histogram) for (metric, labels), histogram in self._histograms.items()
+                                    if metric == name)
+                if not counters and not histograms:
+                    continue
+                full_name = PREFIX + name
+                lines.append(f"# HELP {full_name} {help_text}")
+                lines.append(f"# TYPE {full_name} {kind}")
+                for labels, value in counters:
+                    lines.append(f"{full_name}{_format_labels(labels)} {value}")
+                for labels, histogram in histograms:
+                    for bound, count in histogram.cumulative():
+                        lines.append(f"{full_name}_bucket{_format_labels(labels, le=_format_bound(bound))} {count}")
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum:.6f}")
+                    lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+        lines.append(f"# TYPE {PREFIX}last_update_timestamp_seconds gauge")
+        lines.append(f"{PREFIX}last_update_timestamp_seconds {time.time():.0f}")
+        return '\n'.join(lines) + '\n'
+
+
+def _write_file(path, text):
+    # Written to a temporary file first, so whatever reads it never sees half of it
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.temp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def save_metrics(settings):
+    """Write the metrics to the files set as metrics_textfile and metrics_summary_file, if any."""
+    try:
+        if settings['metrics_textfile']:
+            _write_file(settings['metrics_textfile'], _metrics.prometheus_text())
+        if settings['metrics_summary_file']:
+            _write_file(settings['metrics_summary_file'], json.dumps(_metrics.summary(), indent=2) + '\n')
+    except OSError as e:
+        print(f"Could not save the metrics: {e}")
@@ -0,0 +1,104 @@
+import os
+import json
+import atexit
+import hashlib
+import threading
+import multiprocessing
+import html2text
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from comment_scraper import COMMENTS_HEADER
+
+# Batches with fewer HTML posts than this are converted in this process,
+# starting worker processes isn't worth it for a handful of posts
+PROCESS_POOL_MIN_BATCH = 16
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def text_hash(source):
+    """Hash of everything a post text file is made from."""
+    return hashlib.sha1(json.dumps(source, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Download threads are running by now, and a forked child could inherit a lock one of them holds
+            _pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+@atexit.register
+def _shutdown_pool():
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+
+
+def convert_html(htmls):
+    """Run html2text over a list of HTML strings, on worker processes for big batches."""
+    if len(htmls) >= PROCESS_POOL_MIN_BATCH:
+        try:
+            chunksize = max(1, len(htmls) // (4 * (os.cpu_count() or 1)))
+            return list(_get_pool().map(html2text.html2text, htmls, chunksize=chunksize))
+        except (BrokenProcessPool, OSError) as e:
+            print(f"Could not convert posts on worker processes, converting them here: {e}")
+    return [html2text.html2text(html) for html in htmls]
+
+
+def _existing_comments(path):
+    """Return the [COMMENTS] section of a post text file, so rewriting it doesn't lose it."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+    except OSError:
+        return ""
+    position = text.find(COMMENTS_HEADER)
+    if position == -1 or (position and text[position - 1] != '\n'):
+        return ""
+    return text[position:]
+
+
+class PostTextWriter:
+    """
+    Writes the text files of a batch of posts (content.txt and friends).
+
+    A hash of what each file is made from is kept in the stash ledger, so
+    files whose post didn't change are neither converted nor written again.
+    The HTML of the posts that did change is converted in one batch.
+    """
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self._pending = []
+
+    def add(self, path, source, render, html=None):
+        """
+        Queue the file at path. source is everything the file is made from
+        and render(markdown) returns its text, where markdown is html
+        converted by html2text (None without html). Returns False if the
+        file is already up to date.
+        """
+        digest = text_hash(source)
+        if os.path.exists(path) and self.ledger.get_text_hash(path) == digest:
+            return False
+        self._pending.append((path, digest, render, html))
+        return True
+
+    def flush(self):
+        """Convert and write every queued file. Returns the paths that were written."""
+        pending, self._pending = self._pending, []
+        converted = iter(convert_html([html for path, digest, render, html in pending if html is not None]))
+
+        written = []
+        for path, digest, render, html in pending:
+            text = render(next(converted) if html is not None else None)
+            # Comments are added by the comment scraper, keep them until it refreshes them
+            text += _existing_comments(path)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            self.ledger.record_text_hash(path, digest)
+            written.append(path)
+        return written
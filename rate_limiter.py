@@ -0,0 +1,121 @@
+import time
+import random
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+
+# Requests per second allowed to a single host when nothing is going wrong
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+# The rate never drops below this, however often the server pushes back
+MIN_REQUESTS_PER_SECOND = 0.2
+# Rate regained after every successful request
+RATE_INCREASE = 0.1
+# Consecutive failures that open the circuit of a host, and for how long (seconds)
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 60
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request to a host that keeps failing."""
+
+    def __init__(self, host, retry_in):
+        super().__init__(f"Too many failed requests to {host}, pausing for {retry_in:.0f} seconds")
+        self.retry_in = retry_in
+
+
+def parse_retry_after(value):
+    """Return the number of seconds a Retry-After header asks to wait, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Exponential backoff with full jitter for the given (0-based) retry attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class HostLimiter:
+    """
+    Token bucket for one host. Its rate is halved whenever the server
+    answers 429/503 and slowly grows back with every success, so requests
+    settle at the fastest rate the server accepts. After too many failures
+    in a row the circuit opens and the host is left alone for a while.
+    """
+
+    def __init__(self, host, max_rate):
+        self.host = host
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self._tokens = max(1.0, max_rate)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._failures = 0
+        self._circuit_open_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request to this host may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._circuit_open_until:
+                    raise CircuitOpenError(self.host, self._circuit_open_until - now)
+
+                self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def record_throttled(self, retry_after=None):
+        """The server answered 429/503: slow down and honour Retry-After."""
+        with self._lock:
+            self.rate = max(MIN_REQUESTS_PER_SECOND, self.rate / 2)
+            self._tokens = 0
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._record_failure()
+
+    def record_failure(self):
+        with self._lock:
+            self._record_failure()
+
+    def _record_failure(self):
+        self._failures += 1
+        if self._failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self._circuit_open_until = time.monotonic() + CIRCUIT_COOLDOWN
+            self._failures = 0
+
+
+class RateLimiter:
+    """Keeps one HostLimiter per host, shared by every thread."""
+
+    def __init__(self, requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+        self.requests_per_second = requests_per_second
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def for_host(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostLimiter(host, self.requests_per_second)
+            return self._hosts[host]
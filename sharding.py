@@ -0,0 +1,34 @@
+import hashlib
+import argparse
+
+
+def parse_shard(value):
+    """argparse type of --shard: 'i/N' with 1 <= i <= N, returned as (i, N)."""
+    index, _, count = value.partition('/')
+    if not (index.isdigit() and count.isdigit()) or not 1 <= int(index) <= int(count):
+        raise argparse.ArgumentTypeError(f"expected I/N with 1 <= I <= N, like 1/4, got {value!r}")
+    return int(index), int(count)
+
+
+def shard_of(service, artist_id, shard_count):
+    """
+    Return the shard (1 to shard_count) of an artist. It's a hash of the
+    service and ID, so it's the same on every machine and every run.
+    """
+    digest = hashlib.sha1(f"{service.lower()}:{artist_id}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count + 1
+
+
+def in_shard(artist_url, shard):
+    """True if the artist of an API URL (see get_favorites.get_artist_url) belongs to shard, (i, N) or None."""
+    if shard is None:
+        return True
+    url_parts = artist_url.split('?')[0].split('/')
+    if len(url_parts) < 8:
+        return shard[0] == 1  # Odd URLs all go to the first shard
+    return shard_of(url_parts[5], url_parts[-1], shard[1]) == shard[0]
+
+
+def run_name(option, shard):
+    """Name of the job queue run of a site, one per shard."""
+    return option if shard is None else f"{option}-shard{shard[0]}of{shard[1]}"
@@ -0,0 +1,328 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import threading
+
+LEDGER_FILE_NAME = 'ledger.sqlite3'
+# Marked posts are written to disk in batches of this size
+COMMIT_BATCH_SIZE = 50
+
+_commit_batch_size = COMMIT_BATCH_SIZE
+_journal_mode = 'WAL'
+
+
+def configure(commit_batch_size=None, journal_mode=None):
+    """
+    Settings for ledgers opened from now on. Workers sharing a stash commit
+    every change (commit_batch_size=1) so they don't keep each other waiting,
+    and a stash on a network share needs journal_mode='DELETE'.
+    """
+    global _commit_batch_size, _journal_mode
+    if commit_batch_size is not None:
+        _commit_batch_size = max(1, commit_batch_size)
+    if journal_mode is not None:
+        _journal_mode = journal_mode
+
+
+class StashLedger:
+    """
+    SQLite database kept in the Creators folder of a stash that records
+    which posts have been fully downloaded, keyed by site, service, artist
+    and post ID. It replaces the downloaded_posts.json file that used to
+    live in every artist/service folder, also remembers when each
+    artist was last scanned back to their first post, when the comments
+    of each post were last fetched, what each content.txt was written
+    from and how far each Discord channel was crawled, and indexes the
+    files on disk by the content hash in their Kemono/Coomer path.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Paths are stored relative to the folder of the database
+        self.root = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._commit_batch_size = _commit_batch_size
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._connection.execute(f"PRAGMA journal_mode={_journal_mode}")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS downloaded_posts (
+                    domain TEXT NOT NULL,
+                    service TEXT NOT NULL,
+                    artist_id TEXT NOT NULL,
+                    post_id TEXT NOT NULL,
+                    downloaded_at REAL NOT NULL,
+                    PRIMARY KEY (domain, service, artist_id, post_id)
+                )
+            """)
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_downloaded_posts_post_id ON downloaded_posts (post_id)"
+            )
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS artist_scans (
+                    domain TEXT NOT NULL,
+                    service TEXT NOT NULL,
+                    artist_id TEXT NOT NULL,
+                    last_full_scan REAL NOT NULL,
+                    PRIMARY KEY (domain, service, artist_id)
+                )
+            """)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS comment_scans (
+                    domain TEXT NOT NULL,
+                    service TEXT NOT NULL,
+                    artist_id TEXT NOT NULL,
+                    post_id TEXT NOT NULL,
+                    scanned_at REAL NOT NULL,
+                    PRIMARY KEY (domain, service, artist_id, post_id)
+                )
+            """)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS post_texts (
+                    path TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL
+                )
+            """)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS files (
+                    hash TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL
+                )
+            """)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS discord_channels (
+                    server_id TEXT NOT NULL,
+                    channel_id TEXT NOT NULL,
+                    newest_id TEXT,
+                    crawl_top TEXT,
+                    crawl_bottom TEXT,
+                    crawl_skip INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (server_id, channel_id)
+                )
+            """)
+
+    def filter_downloaded(self, domain, service, artist_id, post_ids):
+        """Return the subset of post_ids that are already downloaded."""
+        post_ids = [str(post_id) for post_id in post_ids if post_id is not None]
+        if not post_ids:
+            return set()
+
+        downloaded = set()
+        with self._lock:
+            # Stay well below SQLite's limit on query parameters
+            for i in range(0, len(post_ids), 500):
+                chunk = post_ids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT post_id FROM downloaded_posts "
+                    f"WHERE domain = ? AND service = ? AND artist_id = ? AND post_id IN ({placeholders})",
+                    [domain.lower(), service.lower(), artist_id, *chunk],
+                )
+                downloaded.update(row[0] for row in rows)
+        return downloaded
+
+    def mark_downloaded(self, domain, service, artist_id, post_id):
+        """Record a finished post. Changes are committed every COMMIT_BATCH_SIZE posts."""
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO downloaded_posts VALUES (?, ?, ?, ?, ?)",
+                (domain.lower(), service.lower(), artist_id, str(post_id), time.time()),
+            )
+            self._written()
+
+    def _written(self):
+        """Count a change, committing once COMMIT_BATCH_SIZE (or the configured number) are pending."""
+        self._pending += 1
+        if self._pending >= self._commit_batch_size:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._connection.commit()
+            self._pending = 0
+
+    def is_full_scan_due(self, domain, service, artist_id, interval_days):
+        """
+        Return True if every page of the artist should be walked: it has
+        never been fully scanned, or its last full scan is older than
+        interval_days (0 means a single full scan is enough).
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT last_full_scan FROM artist_scans WHERE domain = ? AND service = ? AND artist_id = ?",
+                (domain.lower(), service.lower(), artist_id),
+            ).fetchone()
+        if row is None:
+            return True
+        return bool(interval_days) and time.time() - row[0] > interval_days * 86400
+
+    def record_full_scan(self, domain, service, artist_id):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO artist_scans VALUES (?, ?, ?, ?)",
+                (domain.lower(), service.lower(), artist_id, time.time()),
+            )
+            self._written()
+
+    def comment_scans_due(self, domain, service, artist_id, post_ids, refresh_days):
+        """
+        Return the subset of post_ids whose comments should be fetched: never
+        fetched before, or longer than refresh_days ago (0 means only once).
+        """
+        post_ids = [str(post_id) for post_id in post_ids if post_id is not None]
+        scanned = {}
+        with self._lock:
+            for i in range(0, len(post_ids), 500):
+                chunk = post_ids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._connection.execute(
+                    f"SELECT post_id, scanned_at FROM comment_scans "
+                    f"WHERE domain = ? AND service = ? AND artist_id = ? AND post_id IN ({placeholders})",
+                    [domain.lower(), service.lower(), artist_id, *chunk],
+                )
+                scanned.update(rows)
+        now = time.time()
+        return {post_id for post_id in post_ids
+                if post_id not in scanned or (refresh_days and now - scanned[post_id] > refresh_days * 86400)}
+
+    def record_comment_scan(self, domain, service, artist_id, post_id):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO comment_scans VALUES (?, ?, ?, ?, ?)",
+                (domain.lower(), service.lower(), artist_id, str(post_id), time.time()),
+            )
+            self._written()
+
+    def get_text_hash(self, path):
+        """Return the hash of what the post text file at path was written from, or None."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT hash FROM post_texts WHERE path = ?", (os.path.relpath(os.path.abspath(path), self.root),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def record_text_hash(self, path, text_hash):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO post_texts VALUES (?, ?)",
+                (os.path.relpath(os.path.abspath(path), self.root), text_hash),
+            )
+            self._written()
+
+    def find_file(self, content_hash):
+        """Return (path, size) of a stored file with this content hash, or None."""
+        with self._lock:
+            return self._connection.execute(
+                "SELECT path, size FROM files WHERE hash = ?", (content_hash.lower(),)
+            ).fetchone()
+
+    def record_file(self, content_hash, path, size):
+        """Remember where a file with this content hash is stored (path relative to the stash)."""
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?)", (content_hash.lower(), path, size)
+            )
+            self._written()
+
+    def forget_file(self, content_hash):
+        with self._lock:
+            self._connection.execute("DELETE FROM files WHERE hash = ?", (content_hash.lower(),))
+            self._written()
+
+    def get_channel_cursor(self, server_id, channel_id):
+        """
+        Return how far a Discord channel has been crawled as a dict:
+        newest_id is the newest message of the last finished crawl, and
+        crawl_top/crawl_bottom/crawl_skip describe an unfinished crawl (the
+        newest and oldest message handled so far and the offset it reached).
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT newest_id, crawl_top, crawl_bottom, crawl_skip FROM discord_channels "
+                "WHERE server_id = ? AND channel_id = ?",
+                (str(server_id), str(channel_id)),
+            ).fetchone()
+        if row is None:
+            return {'newest_id': None, 'crawl_top': None, 'crawl_bottom': None, 'crawl_skip': 0}
+        return dict(zip(('newest_id', 'crawl_top', 'crawl_bottom', 'crawl_skip'), row))
+
+    def save_channel_progress(self, server_id, channel_id, crawl_top, crawl_bottom, crawl_skip):
+        """Record the progress of an unfinished crawl, committed right away so a crash can resume from it."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO discord_channels (server_id, channel_id, crawl_top, crawl_bottom, crawl_skip, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (server_id, channel_id) DO UPDATE SET "
+                "crawl_top = excluded.crawl_top, crawl_bottom = excluded.crawl_bottom, "
+                "crawl_skip = excluded.crawl_skip, updated_at = excluded.updated_at",
+                (str(server_id), str(channel_id), crawl_top, crawl_bottom, crawl_skip, time.time()),
+            )
+
+    def finish_channel_crawl(self, server_id, channel_id, newest_id):
+        """Record that every message up to newest_id has been handled."""
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO discord_channels VALUES (?, ?, ?, NULL, NULL, 0, ?)",
+                (str(server_id), str(channel_id), newest_id, time.time()),
+            )
+
+    def migrate_json(self, domain, service, artist_id, platform_folder):
+        """
+        Import the post IDs of an old downloaded_posts.json file, then rename
+        it to downloaded_posts.json.migrated so it's only imported once.
+        """
+        json_path = os.path.join(platform_folder, "downloaded_posts.json")
+        if not os.path.exists(json_path):
+            return 0
+
+        try:
+            with open(json_path, 'r', encoding='utf-8') as file:
+                post_ids = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Could not read {json_path}: {e}")
+            return 0
+
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO downloaded_posts VALUES (?, ?, ?, ?, ?)",
+                [(domain.lower(), service.lower(), artist_id, str(post_id), now) for post_id in post_ids],
+            )
+        os.replace(json_path, json_path + ".migrated")
+        return len(post_ids)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_stash_ledger(stash_path):
+    """Return the ledger of the stash at stash_path, opening it on first use."""
+    db_path = os.path.abspath(os.path.join(stash_path, "Creators", LEDGER_FILE_NAME))
+    with _ledgers_lock:
+        if db_path not in _ledgers:
+            _ledgers[db_path] = StashLedger(db_path)
+        return _ledgers[db_path]
+
+
+@atexit.register
+def _flush_ledgers():
+    for ledger in list(_ledgers.values()):
+        try:
+            ledger.flush()
+        except sqlite3.Error:
+            pass
@@ -0,0 +1,161 @@
+import os
+import time
+import queue
+import threading
+import requests
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+
+# Reads start at MIN_CHUNK_SIZE and grow or shrink so one read takes about
+# TARGET_READ_SECONDS: large reads on fast links, quick progress on slow ones
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+TARGET_READ_SECONDS = 0.25
+# Progress callbacks are batched to at most one per this many seconds
+PROGRESS_INTERVAL = 0.2
+# Buffers handed to the write-behind thread before reading has to wait for the disk
+WRITE_BEHIND_BUFFERS = 4
+
+
+def preallocate(f, size):
+    """
+    Reserve size bytes for f in one go so the file isn't fragmented as it
+    grows. Falls back to a sparse file where posix_fallocate is missing or
+    not supported by the file system.
+    """
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    f.truncate(size)
+
+
+def _read_into(raw, view):
+    """raw.readinto with urllib3's errors turned into the ones requests raises."""
+    try:
+        return raw.readinto(view)
+    except ProtocolError as e:
+        raise requests.exceptions.ChunkedEncodingError(e)
+    except ReadTimeoutError as e:
+        raise requests.exceptions.ConnectionError(e)
+    except DecodeError as e:
+        raise requests.exceptions.ContentDecodingError(e)
+
+
+class StreamWriter:
+    """
+    Copies the body of a streamed response into an open file.
+
+    The body is read with readinto() into a few reused buffers, whose used
+    size adapts to the speed of the connection, and progress is reported in
+    batches instead of once per chunk. With write_behind the writes happen on
+    a separate thread, so a slow disk doesn't stall the socket.
+    """
+
+    def __init__(self, file, progress=None, write_behind=False):
+        self.file = file
+        self.progress = progress
+        self.write_behind = write_behind
+        self.written = 0
+        self._unreported = 0
+        self._last_report = time.monotonic()
+
+    def _report(self, size, force=False):
+        self._unreported += size
+        now = time.monotonic()
+        if self.progress and self._unreported and (force or now - self._last_report >= PROGRESS_INTERVAL):
+            self.progress(self._unreported)
+            self._unreported = 0
+            self._last_report = now
+
+    def _write(self, view):
+        self.file.write(view)
+        self.written += len(view)
+        self._report(len(view))
+
+    def copy(self, response, limit=None):
+        """
+        Write the body of response (at most limit bytes) at the current
+        position of the file. Returns the number of bytes written.
+        """
+        raw = getattr(response, 'raw', None)
+        if raw is None or not hasattr(raw, 'readinto'):
+            # Not a urllib3 response, fall back to the slower iterator
+            for data in response.iter_content(MIN_CHUNK_SIZE):
+                if limit is not None:
+                    data = data[:limit - self.written]
+                self._write(data)
+                if limit is not None and self.written >= limit:
+                    break
+            self._report(0, force=True)
+            return self.written
+
+        # Let urllib3 undo any gzip/deflate Content-Encoding like iter_content would
+        raw.decode_content = True
+        try:
+            if self.write_behind:
+                self._copy_write_behind(raw, limit)
+            else:
+                buffer = memoryview(bytearray(MAX_CHUNK_SIZE))
+                for view in self._read_chunks(raw, lambda: buffer, limit):
+                    self._write(view)
+        finally:
+            self._report(0, force=True)
+        return self.written
+
+    def _read_chunks(self, raw, next_buffer, limit):
+        """Yield filled slices of the buffers returned by next_buffer()."""
+        chunk_size = MIN_CHUNK_SIZE
+        read = 0
+        while limit is None or read < limit:
+            size = chunk_size if limit is None else min(chunk_size, limit - read)
+            buffer = next_buffer()
+            started = time.monotonic()
+            count = _read_into(raw, buffer[:size])
+            if not count:
+                break
+            read += count
+            yield buffer[:count]
+
+            elapsed = time.monotonic() - started
+            if count == size and elapsed < TARGET_READ_SECONDS / 2:
+                chunk_size = min(MAX_CHUNK_SIZE, chunk_size * 2)
+            elif elapsed > TARGET_READ_SECONDS * 2:
+                chunk_size = max(MIN_CHUNK_SIZE, chunk_size // 2)
+
+    def _copy_write_behind(self, raw, limit):
+        free = queue.Queue()
+        for _ in range(WRITE_BEHIND_BUFFERS):
+            free.put(memoryview(bytearray(MAX_CHUNK_SIZE)))
+        pending = queue.Queue()
+        errors = []
+
+        def writer():
+            while True:
+                view = pending.get()
+                if view is None:
+                    return
+                try:
+                    if not errors:
+                        self._write(view)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    # Hand the whole buffer back, not just the slice that was written
+                    free.put(memoryview(view.obj))
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+        try:
+            for view in self._read_chunks(raw, free.get, limit):
+                if errors:
+                    break
+                pending.put(view)
+        finally:
+            pending.put(None)
+            thread.join()
+        if errors:
+            raise errors[0]
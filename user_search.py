@@ -1,15 +1,12 @@
 import os
 import re
-import requests
 import get_favorites
+from creator_index import get_creator_index
 
 
 def fetch_creator_data():
-    # Fetching creator data from kemono and coomer using the new API endpoint
-    kemono_data = requests.get("https://kemono.su/api/v1/creators.txt").json()
-    coomer_data = requests.get("https://coomer.su/api/v1/creators.txt").json()
-
-    return kemono_data + coomer_data
+    # Index of the creators from kemono and coomer, shared with the rest of the run
+    return get_creator_index()
 
 
 def display_options(id_name_service_mapping):
@@ -57,14 +54,11 @@ def get_list_of_user_urls(found_user_data, all_urls):
             domain = "coomer.su"
         else:
             domain = "kemono.su"
-        user_url = f"https://{domain}/api/{service}/user/{artist_id}"
-        post_pages = get_favorites.get_all_page_urls(domain, service, artist_id, [user_url])
-        post_pages.pop(0)
-    all_urls.extend(post_pages)
+        all_urls.append(get_favorites.get_artist_url(domain, service, artist_id))
     return all_urls
 
 
-def find_and_return_entries(data_list, input_username):
+def find_and_return_entries(creators, input_username):
     # Check if input_username is a URL
     # Modified regex to account for usernames with periods
     url_pattern = r"https://(?P<cookie_domain>\w+\.su)/(?P<service>\w+)/(user|server)/(?P<artist_id>[\w.]+)(\?o=0)?"
@@ -74,21 +68,19 @@ def find_and_return_entries(data_list, input_username):
         artist_id = match.group("artist_id")
         service = match.group("service")
         
-        # Filter the data list to get the corresponding user or server entry
-        for item in data_list:
-            if item.get("id") == artist_id and item.get("service") == service:
-                return [item]
+        # Look up the corresponding user or server entry
+        if item := creators.get(artist_id, service):
+            return [item]
                 
     # If not a URL, proceed with the original logic
     input_username = input_username.strip().lower()
     potential_matches = []
 
-    for item in data_list:
+    for item in creators.find_by_name(input_username):
         name = item.get('name', '').strip().lower()
         service = item.get('service', '').capitalize()
-        if name == input_username:
-            artist_service = f"{name.capitalize()} ({service})"
-            potential_matches.append((artist_service, item))
+        artist_service = f"{name.capitalize()} ({service})"
+        potential_matches.append((artist_service, item))
 
     # If no matches found
     if not potential_matches:
@@ -115,15 +107,18 @@ def find_and_return_entries(data_list, input_username):
 
 
 def main(input_username):
-    combined_data = fetch_creator_data()
-    matched_entries = find_and_return_entries(combined_data, input_username)
+    creators = fetch_creator_data()
+    matched_entries = find_and_return_entries(creators, input_username)
 
     # Example URL and username for demonstration
     example_url = "https://kemono.su/patreon/user/19627910"
     example_username = "otakugirl90"
 
     while not matched_entries:
+        suggestions = creators.suggest(input_username)
+        did_you_mean = f"Did you mean: {', '.join(suggestions)}?\n" if suggestions else ""
         choice = input(f"No matching entries found for {input_username.capitalize()}.\n"
+                       f"{did_you_mean}"
                        f"Did you spell the URL or username correctly?\n"
                        f"Example URL: {example_url}\n"
                        f"Example Username: {example_username}\n"
@@ -131,7 +126,7 @@ def main(input_username):
 
         if choice == 'y':
             input_username = input("Please enter the correct URL or username: ")
-            matched_entries = find_and_return_entries(combined_data, input_username)
+            matched_entries = find_and_return_entries(creators, input_username)
         else:
             print("Exiting the program.")
             return None, None, None
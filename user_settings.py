@@ -0,0 +1,167 @@
+import os
+import yaml
+import threading
+from types import MappingProxyType
+from collections.abc import Mapping
+from download_plan import FileFilter
+
+SETTINGS_FILE = os.path.join('Config', 'user_settings.yaml')
+
+
+def load_settings():
+    dir_path = 'Config'
+    file_name = 'user_settings.yaml'
+    file_path = os.path.join(dir_path, file_name)
+
+    # Default settings
+    settings = {
+        'stash_path': './',
+        'post_limit': 0,  # 0 downloads all posts from the artist, it's the default value
+        'disk_limit': 0,  # 0 disables the download limit. Expressed in MB
+        'download_preference' : 0,
+        'minimum_file_size' : 0,
+        'maximum_file_size' : 0,
+        'file_type_to_download' : ['Image', 'GIF', 'Video', 'Compressed', 'PSD', 'Other'],
+        'show_startup_logo' : 0,
+        'create_post_folder': True,
+        'max_concurrent_downloads': 4,  # Files downloaded at the same time
+        'max_downloads_per_host': 2,  # Simultaneous downloads from the same server
+        'disk_usage_rescan_days': 7,  # Recount the stash size from scratch after this many days
+        'creator_catalog_ttl_hours': 1,  # Reuse the saved creator list for this long before revalidating it
+        'requests_per_second': 5,  # Highest request rate to a single site, lowered automatically when it pushes back
+        'max_retries': 4,  # Retries for failed requests, with growing waits in between
+        'incremental_sync_known_posts': 50,  # Stop paging an artist after this many downloaded posts in a row, 0 disables it
+        'full_scan_interval_days': 30,  # Walk every page of an artist again after this many days, 0 disables it
+        'segmented_download_min_size': 50,  # Files of at least this many MB are downloaded over several connections, 0 disables it
+        'segments_per_file': 4,  # Number of connections used for one of those files
+        'write_behind': False,  # Write files to disk on a separate thread so a slow disk doesn't hold up downloads
+        'scrape_comments': True,  # Fetch post comments into content.txt in the background
+        'comment_refresh_days': 0,  # Fetch the comments of downloaded posts again after this many days, 0 fetches them once
+        'discord_channel_workers': 4,  # Channels of a Discord server crawled at the same time
+        'watch_interval_minutes': 15,  # Minutes between checks of the favorites in watch mode (-w)
+        'metrics_textfile': '',  # Prometheus textfile the metrics are written to after every run, empty turns it off
+        'metrics_summary_file': '',  # JSON file the metrics are written to after every run, empty turns it off
+        'shared_stash': False,  # Set when the stash and Config/ are shared with other machines over a network drive
+        # File type extensions
+        'file_type_extensions' : {
+            'Image': [
+                '.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.svg', 
+                '.webp', '.raw', '.heif', '.indd', '.ai', '.eps'
+            ],
+            'GIF': [
+                '.gif'
+            ],
+            'Video': [
+                '.mp4', '.avi', '.mov', '.wmv', '.flv', '.mkv', '.webm', 
+                '.m4v', '.mpg', '.mpeg', '.3gp', '.vob', '.swf'
+            ],
+            'Compressed': [
+                '.zip', '.rar', '.7z', '.tar', '.gz', '.bz2', '.xz', '.iso', '.tgz'
+            ],
+            'Audio': [
+                '.mp3', '.wav', '.aac', '.flac', '.ogg', '.m4a', '.wma', 
+                '.alac', '.amr'
+            ],
+            'PSD': [
+                '.psd'
+            ]
+        }
+
+    }
+
+    # Check if the directory exists, if not create it
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+
+    # Check if the YAML file exists, if not create it
+    if not os.path.exists(file_path):
+        save_settings(settings)
+
+    # Read the YAML file
+    with open(file_path, 'r', encoding='utf-8') as settings_file:
+        try:
+            loaded_settings = yaml.safe_load(settings_file)
+            settings.update(loaded_settings)
+        except yaml.YAMLError as e:
+            print(f"Error reading settings file: {e}")
+
+    return settings
+
+
+def save_settings(settings):
+    dir_path = 'Config'
+    file_name = 'user_settings.yaml'
+    file_path = os.path.join(dir_path, file_name)
+
+    # Check if the directory exists, if not create it
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+
+    with open(file_path, 'w', encoding='utf-8') as settings_file:
+        yaml.dump(settings, settings_file, default_flow_style=False)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+class Settings(Mapping):
+    """
+    Read-only snapshot of user_settings.yaml with the values the download
+    pipeline needs precomputed, so checking a file doesn't parse YAML or
+    convert sizes again. Read it like the dict load_settings() returns.
+    """
+
+    def __init__(self, values, mtime=None):
+        self._values = _freeze(values)
+        self.mtime = mtime
+        # Byte versions of the MB settings, 0 means no limit
+        self.disk_limit_bytes = int(values['disk_limit'] * 1024 * 1024)
+        self.minimum_file_size_bytes = int(values['minimum_file_size'] * 1024 * 1024)
+        self.maximum_file_size_bytes = int(values['maximum_file_size'] * 1024 * 1024)
+        self.segment_threshold_bytes = int(values['segmented_download_min_size'] * 1024 * 1024)
+        # Extension lookup table for the file type filter
+        self.file_filter = FileFilter(self)
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError("Settings snapshots are read-only, use load_settings() to change settings")
+        super().__setattr__(name, value)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def _settings_mtime():
+    try:
+        return os.stat(SETTINGS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_settings():
+    """
+    Return the settings snapshot, reading user_settings.yaml again only
+    when the file was changed since the last call.
+    """
+    global _snapshot
+    with _snapshot_lock:
+        if _snapshot is None or _snapshot.mtime != _settings_mtime():
+            values = load_settings()
+            _snapshot = Settings(values, _settings_mtime())
+        return _snapshot